@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""Asyncio variant of GarminHealth, to pull summaries for many users and endpoints concurrently."""
+
+import asyncio
+import logging
+import time
+
+import aiohttp
+from oauthlib.oauth1 import Client
+
+from .garmin_health import API_DAILIES, API_ACTIVITIES, API_SLEEPS, API_BODY, API_STRESS, API_USER_METRICS, API_MOVEIQ, RETRY, \
+    GarminHealthFatalException, timestamp_calculator, query_chunks, summary_url
+from .rate_limit import TokenBucket
+from .retry import RetryPolicy
+
+# Summary endpoints by the names GarminHealth uses for them
+SUMMARY_URLS = {
+    'dailies': API_DAILIES,
+    'activities': API_ACTIVITIES,
+    'sleep': API_SLEEPS,
+    'body': API_BODY,
+    'stress': API_STRESS,
+    'userMetrics': API_USER_METRICS,
+    'moveIQ': API_MOVEIQ,
+}
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class AsyncGarminHealth(object):
+    """
+    Garmin Health API client for users that are already authorized, like GarminMember objects.
+    Requests for all users and endpoints run concurrently, with at most max_concurrency requests in flight and at most
+    user_rate requests per second for the same user. Failed requests are retried according to retry_policy, which defaults to
+    the one of GarminHealth.query.
+
+    Use it as an async context manager:
+
+        async with AsyncGarminHealth(consumer_key, consumer_secret) as garmin:
+            results = await garmin.summaries(garmin_members, start_time=start_time, end_time=end_time)
+    """
+
+    def __init__(self, consumer_key, consumer_secret, max_concurrency=10, user_rate=1, timeout=60, retry_policy=None):
+        self._consumer_key = consumer_key
+        self._consumer_secret = consumer_secret
+        self._max_concurrency = max_concurrency
+        self._user_rate = user_rate
+        self._timeout = timeout
+        self._retry_policy = retry_policy
+        self._semaphore = None
+        self._session = None
+        self._user_rate_limits = {}  # access token -> TokenBucket
+
+    async def __aenter__(self):
+        self._semaphore = asyncio.Semaphore(self._max_concurrency)
+        self._session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self._max_concurrency),
+            timeout=aiohttp.ClientTimeout(total=self._timeout),
+        )
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self._session.close()
+        self._session = None
+
+    def _sign(self, user, url, method):
+        client = Client(self._consumer_key, client_secret=self._consumer_secret,
+                        resource_owner_key=user.access_token, resource_owner_secret=user.access_token_secret)
+        _, headers, _ = client.sign(url, http_method=method)
+        return headers
+
+    async def _wait_for_user(self, user):
+        rate_limit = self._user_rate_limits.setdefault(user.access_token, TokenBucket(self._user_rate))
+        while not rate_limit.try_acquire():
+            await asyncio.sleep(rate_limit.time_until_available())
+
+    async def query(self, user, url, method='GET', retry=RETRY, retry_policy=None):
+        """
+        Same as GarminHealth.query, for the given user. Waiting for a retry doesn't hold up the other requests, nor takes up
+        one of the max_concurrency requests in flight.
+        """
+        retry_policy = retry_policy or self._retry_policy or RetryPolicy('garmin', max_attempts=retry + 1)
+        deadline = time.monotonic() + retry_policy.deadline
+        attempt = 0
+        while True:
+            attempt += 1
+            await self._wait_for_user(user)
+            try:
+                async with self._semaphore:
+                    _LOGGER.debug("Querying %s", url)
+                    async with self._session.request(method, url, headers=self._sign(user, url, method)) as resp:
+                        if resp.status == 200:
+                            return await resp.json(content_type=None)
+                        if resp.status == 403:
+                            raise GarminHealthFatalException("Invalid OAuth1 Token. Consider refreshing it!!")
+                        error = f"got response {resp.status} for {url}"
+                        retryable, delay = retry_policy.is_retryable_status(resp.status), retry_policy.delay(attempt, resp)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as error_msg:
+                error = error_msg
+                retryable, delay = True, retry_policy.delay(attempt)
+
+            if not retryable or attempt >= retry_policy.max_attempts or time.monotonic() + delay > deadline:
+                _LOGGER.error("Error: %s", error)
+                raise GarminHealthFatalException("Something went wrong!!!")
+            retry_policy.count_retry(delay)
+            await asyncio.sleep(delay)
+
+    async def summary(self, user, name, start_time=None, end_time=None):
+        """
+        Summaries of one of the SUMMARY_URLS for the user, uploaded between start_time and end_time (defaults to the last 24hrs).
+        Ranges of more than MAX_QUERY_SECONDS are queried in concurrent chunks.
+        """
+        if start_time is None and end_time is None:
+            start_time, end_time = timestamp_calculator()
+
+        chunks = await asyncio.gather(*[self.query(user, summary_url(SUMMARY_URLS[name], chunk_start, chunk_end))
+                                        for chunk_start, chunk_end in query_chunks(start_time, end_time)])
+        return [summary for chunk in chunks for summary in chunk]
+
+    async def summaries(self, users, names=None, start_time=None, end_time=None):
+        """
+        Summaries for every user and endpoint name (all SUMMARY_URLS by default), fetched concurrently.
+        Returns a list of (user, name, summaries), with the exception instead of the summaries if fetching them failed.
+        """
+        names = list(SUMMARY_URLS.keys()) if names is None else names
+        keys = [(user, name) for user in users for name in names]
+        results = await asyncio.gather(*[self.summary(user, name, start_time, end_time) for user, name in keys], return_exceptions=True)
+        return [(user, name, result) for (user, name), result in zip(keys, results)]
+
+
+def pull_summaries(consumer_key, consumer_secret, users, names=None, start_time=None, end_time=None, **kwargs):
+    """Blocking shortcut for AsyncGarminHealth.summaries, for code that doesn't run in an event loop."""
+    async def pull():
+        async with AsyncGarminHealth(consumer_key, consumer_secret, **kwargs) as garmin:
+            return await garmin.summaries(users, names, start_time, end_time)
+
+    return asyncio.run(pull())
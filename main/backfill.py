@@ -0,0 +1,289 @@
+import logging
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.utils import timezone
+from requests.exceptions import RequestException
+
+from . import metrics
+from .consts import BACKFILL_SECONDS, BACKFILL_MIN_YEAR, GARMIN_BACKFILL_URLS, GARMIN_BACKFILL_DATA_TYPES, BACKFILL_SLEEP_BETWEEN_CALLS, \
+    BACKFILL_RETRY_COUNTDOWN, BACKFILL_MAX_RETRY_COUNTDOWN, BACKFILL_MAX_EMPTY_WINDOWS, BACKFILL_EMPTY_GRACE_SECONDS
+from .helpers import get_oh_user_from_garmin_id
+from .http_pool import oauth1_session
+from .models import GarminMember, BackfillCursor, RetrievedData
+from .rate_limit import TokenBucket
+from .retry import RetryPolicy
+from .wakeup import BACKFILL_CHANNEL, get_wakeup, next_idle_sleep
+
+_LOGGER = logging.getLogger(__name__)
+
+# Short retries of a single backfill call, while the member keeps its place in the backfill
+call_retry_policy = RetryPolicy('backfill', max_attempts=3, base_delay=2, max_delay=10, deadline=30)
+# After that, the url of the cursor is retried later without holding up the other urls
+cursor_retry_policy = RetryPolicy('backfill_cursor', base_delay=BACKFILL_RETRY_COUNTDOWN, max_delay=BACKFILL_MAX_RETRY_COUNTDOWN)
+
+
+def load_backfill_cursors(garmin_member):
+    """The backfill cursor of the member for every backfill url, in order of priority. New cursors start at the current time."""
+    cursors = {cursor.url: cursor for cursor in garmin_member.backfill_cursors.all()}
+    now = timezone.now()
+    for url in GARMIN_BACKFILL_URLS:
+        if url not in cursors:
+            cursors[url], _ = BackfillCursor.objects.get_or_create(garmin_member=garmin_member, url=url, defaults={'backfilled_from': now, 'started_from': now})
+    return [cursors[url] for url in GARMIN_BACKFILL_URLS]
+
+
+def load_min_dates(garmin_member):
+    """Date of the oldest summary received so far, per data type."""
+    return {retrieved_data.data_type: retrieved_data.min_date for retrieved_data in RetrievedData.objects.filter(member=garmin_member.member)}
+
+
+def next_window(cursor):
+    return cursor.backfilled_from - timedelta(seconds=BACKFILL_SECONDS), cursor.backfilled_from
+
+
+def remaining_windows(cursor):
+    """Windows left to request before reaching BACKFILL_MIN_YEAR."""
+    min_start_date = datetime(BACKFILL_MIN_YEAR, 1, 1, tzinfo=timezone.utc)
+    return max(0, int((cursor.backfilled_from - min_start_date).total_seconds() // BACKFILL_SECONDS))
+
+
+def empty_windows(cursor, min_dates):
+    """Windows requested for the cursor that are older than every summary received for its data type."""
+    data_type = GARMIN_BACKFILL_DATA_TYPES[cursor.url.rsplit('/', 1)[1]]
+    oldest_data = min(min_dates.get(data_type, cursor.started_from), cursor.started_from)
+    return max(0, int((oldest_data - cursor.backfilled_from).total_seconds() // BACKFILL_SECONDS))
+
+
+def next_call_at(cursor, min_dates, now):
+    """
+    When the next window of the cursor can be requested, None if the backfill for its url is done: either BACKFILL_MIN_YEAR was reached
+    or Garmin pushed nothing for the last BACKFILL_MAX_EMPTY_WINDOWS windows, which usually means the device is younger than that.
+    """
+    if remaining_windows(cursor) == 0:
+        return None
+    if empty_windows(cursor, min_dates) >= BACKFILL_MAX_EMPTY_WINDOWS:
+        if cursor.last_called_at is None:
+            return None
+        # Garmin pushes the summaries of a backfill some time after the call, give it a chance before giving up
+        pushed_by = cursor.last_called_at + timedelta(seconds=BACKFILL_EMPTY_GRACE_SECONDS)
+        return None if pushed_by <= now else pushed_by
+    if cursor.retry_after is not None and cursor.retry_after > now:
+        return cursor.retry_after
+    return now
+
+
+def backfill_url(cursor):
+    start_date, end_date = next_window(cursor)
+    return f"{cursor.url}?summaryStartTimeInSeconds={int(start_date.timestamp())}&summaryEndTimeInSeconds={int(end_date.timestamp())}"
+
+
+def backfill_calls(garmin_member, cursors):
+    """
+    Yields the cursors that have a backfill call to make. Every round takes one window per url, the most recent windows first and
+    in order of priority of the urls for the same window.
+    The caller records the result of every call on the cursor before taking the next one.
+    """
+    while True:
+        min_dates = load_min_dates(garmin_member)
+        now = timezone.now()
+        ready = [cursor for cursor in cursors if next_call_at(cursor, min_dates, now) == now]
+        if len(ready) == 0:
+            return
+        ready.sort(key=lambda cursor: cursor.backfilled_from, reverse=True)  # stable, so keeps the priority for the same window
+        for cursor in ready:
+            yield cursor
+
+
+def record_backfill_call(cursor, succeeded, response=None):
+    cursor.last_called_at = timezone.now()
+    if succeeded:
+        cursor.backfilled_from, _ = next_window(cursor)
+        cursor.failures = 0
+        cursor.retry_after = None
+    else:
+        cursor.failures += 1
+        cursor.retry_after = timezone.now() + timedelta(seconds=cursor_retry_policy.delay(cursor.failures, response))
+    cursor.save()
+
+
+def create_oauth_session(garmin_member):
+    return oauth1_session(
+        client_key=settings.GARMIN_KEY,
+        client_secret=settings.GARMIN_SECRET,
+        resource_owner_key=garmin_member.access_token,
+        resource_owner_secret=garmin_member.access_token_secret
+    )
+
+
+def call_backfill(oauth, garmin_member, cursor):
+    """
+    Ask Garmin to push the summaries of the next window of the cursor, and record the result on the cursor.
+    Returns False if the backfill for this member should stop.
+    """
+    summary_url = backfill_url(cursor)
+    try:
+        res = call_retry_policy.call(lambda: oauth.get(url=summary_url))
+    except RequestException as e:
+        _LOGGER.error(f"Backfill call {summary_url} failed: {e}")
+        record_backfill_call(cursor, False)
+        return True
+
+    if res.status_code != 202:
+        _LOGGER.error(f"Invalid response for backfill url {summary_url}, got response response: {res.content},{res.status_code}")
+        if res.status_code == 403:
+            # Something is wrong with the user authorisation token. He might have removed the authorization...
+            garmin_member.has_health_export_permission = False
+            garmin_member.save()
+            # The backfill resumes from the cursors once the member is authorized again
+            return False
+        # Only this url is retried later, the others continue
+        record_backfill_call(cursor, False, res)
+        return True
+
+    _LOGGER.info(f"Called backfill {summary_url}")
+    record_backfill_call(cursor, True)
+    return True
+
+
+def next_backfill_retry(garmin_member, cursors):
+    """Time at which the backfill of a member with these cursors can continue, None if it finished."""
+    min_dates = load_min_dates(garmin_member)
+    now = timezone.now()
+    retries = [next_call_at(cursor, min_dates, now) for cursor in cursors]
+    retries = [retry for retry in retries if retry is not None]
+    if len(retries) == 0:
+        return None
+    return min(retries)
+
+
+def finish_backfill(garmin_member, cursors):
+    calls = sum(int((cursor.started_from - cursor.backfilled_from).total_seconds() // BACKFILL_SECONDS) for cursor in cursors)
+    calls_saved = sum(remaining_windows(cursor) for cursor in cursors)
+    metrics.increment('backfill_calls_saved', calls_saved)
+    garmin_member.was_backfilled = True
+    garmin_member.save()
+    _LOGGER.info(f"Backfill finished for user {get_oh_user_from_garmin_id(garmin_member.userid)} after {calls} calls, "
+                 f"skipped {calls_saved} calls for windows without data")
+
+
+def handle_backfill_for_member(garmin_member, is_terminated=lambda: False):
+    """Backfill a single member, one call after the other, until it finished or only calls waiting for a retry are left."""
+    oauth = create_oauth_session(garmin_member)
+    rate_limit = TokenBucket(1 / BACKFILL_SLEEP_BETWEEN_CALLS)
+    cursors = load_backfill_cursors(garmin_member)
+    _LOGGER.info(f"Executing backfill for user {get_oh_user_from_garmin_id(garmin_member.userid)}")
+    for cursor in backfill_calls(garmin_member, cursors):
+        if not rate_limit.acquire(is_terminated):
+            return  # Terminate this thread
+        if not call_backfill(oauth, garmin_member, cursor):
+            return
+    if next_backfill_retry(garmin_member, cursors) is None:
+        finish_backfill(garmin_member, cursors)
+
+
+class MemberBackfill(object):
+    """Progress of the backfill of a single member in the BackfillScheduler."""
+
+    def __init__(self, garmin_member):
+        self.garmin_member = garmin_member
+        self.oauth = create_oauth_session(garmin_member)
+        self.rate_limit = TokenBucket(1 / BACKFILL_SLEEP_BETWEEN_CALLS)
+        self.call = None  # Future of the backfill call in progress
+        self.cursors = load_backfill_cursors(garmin_member)
+        self._calls = backfill_calls(garmin_member, self.cursors)
+        self.next_cursor = next(self._calls, None)
+
+    def advance(self):
+        self.next_cursor = next(self._calls, None)
+
+
+class BackfillScheduler(object):
+    """
+    Backfills many members concurrently. The calls for a single member stay BACKFILL_SLEEP_BETWEEN_CALLS apart, as before,
+    while the calls for all members together are limited to BACKFILL_MAX_CALLS_PER_SECOND.
+    """
+
+    def __init__(self, is_terminated):
+        self._is_terminated = is_terminated
+        self._max_members = settings.BACKFILL_MAX_CONCURRENT_MEMBERS
+        self._rate_limit = TokenBucket(settings.BACKFILL_MAX_CALLS_PER_SECOND)
+        self._members = OrderedDict()  # GarminMember.id -> MemberBackfill, in round robin order
+        self._retry_after = {}  # GarminMember.id -> time before which a member waiting for retries isn't picked up again
+        self._wakeup = get_wakeup(BACKFILL_CHANNEL)
+
+    def run(self):
+        idle_sleep = None
+        next_refresh = 0
+        refreshed_generation = None
+        with ThreadPoolExecutor(settings.BACKFILL_NUM_THREADS, thread_name_prefix='backfill') as executor:
+            while not self._is_terminated():
+                generation = self._wakeup.generation
+                self._collect_finished_calls()
+
+                if len(self._members) < self._max_members and (time.monotonic() >= next_refresh or generation != refreshed_generation):
+                    refreshed_generation = generation
+                    idle_sleep = None if self._add_members() > 0 else next_idle_sleep(idle_sleep)
+                    next_refresh = time.monotonic() + (idle_sleep or 0)
+
+                self._start_calls(executor)
+
+                timeout = self._time_until_next_call()
+                if len(self._members) < self._max_members:
+                    timeout = min(timeout, max(0.0, next_refresh - time.monotonic()))
+                self._wakeup.wait(max(timeout, 0.05), generation)
+
+    def _add_members(self):
+        now = timezone.now()
+        self._retry_after = {member_id: retry_after for member_id, retry_after in self._retry_after.items() if retry_after > now}
+        garmin_members = GarminMember.objects.filter(was_backfilled=False, userid__isnull=False, has_health_export_permission=True) \
+            .exclude(id__in=list(self._members.keys()) + list(self._retry_after.keys())) \
+            .order_by('id')[:self._max_members - len(self._members)]
+        for garmin_member in garmin_members:
+            _LOGGER.info(f"Executing backfill for user {get_oh_user_from_garmin_id(garmin_member.userid)}")
+            self._members[garmin_member.id] = MemberBackfill(garmin_member)
+        return len(garmin_members)
+
+    def _start_calls(self, executor):
+        for member_id in list(self._members.keys()):
+            member = self._members[member_id]
+            if member.call is not None or member.next_cursor is None or member.rate_limit.time_until_available() > 0:
+                continue
+            if not self._rate_limit.try_acquire():
+                break
+            member.rate_limit.try_acquire()
+            member.call = executor.submit(call_backfill, member.oauth, member.garmin_member, member.next_cursor)
+            self._members.move_to_end(member_id)  # Let the other members go first next time
+
+    def _collect_finished_calls(self):
+        for member_id, member in list(self._members.items()):
+            if member.call is not None and member.call.done():
+                try:
+                    proceed = member.call.result()
+                except Exception as e:
+                    _LOGGER.error(f"Backfill call {backfill_url(member.next_cursor)} failed: {e}")
+                    proceed = False
+                member.call = None
+
+                if not proceed:
+                    del self._members[member_id]
+                    self._retry_after[member_id] = timezone.now() + timedelta(seconds=BACKFILL_RETRY_COUNTDOWN)
+                    continue
+                member.advance()
+
+            if member.call is None and member.next_cursor is None:
+                del self._members[member_id]
+                retry_after = next_backfill_retry(member.garmin_member, member.cursors)
+                if retry_after is None:
+                    finish_backfill(member.garmin_member, member.cursors)
+                else:
+                    self._retry_after[member_id] = retry_after
+
+    def _time_until_next_call(self):
+        waits = [member.rate_limit.time_until_available() for member in self._members.values() if member.next_cursor is not None]
+        if len(waits) == 0:
+            return float('inf')
+        return max(min(waits), self._rate_limit.time_until_available())
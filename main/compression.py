@@ -0,0 +1,142 @@
+import json
+import zlib
+
+READ_BLOCK_BYTES = 65536
+JSON_STREAM_ITEMS_PER_SLICE = 256
+
+# The first byte of compressed JSON tells how the rest is encoded, so other formats can be added later
+ZLIB_JSON_FORMAT = b'z'
+ZLIB_LEVEL = 6
+
+GZIP_MAGIC = b'\x1f\x8b'  # JSON never starts with these bytes
+
+
+def compress_json(data):
+    return compress_json_string(json.dumps(data))
+
+
+def compress_json_string(json_string):
+    return ZLIB_JSON_FORMAT + zlib.compress(json_string.encode('utf-8'), ZLIB_LEVEL)
+
+
+def decompress_json(compressed):
+    compressed = bytes(compressed)  # Postgres returns a memoryview
+    data_format = compressed[:1]
+    if data_format == ZLIB_JSON_FORMAT:
+        return json.loads(zlib.decompress(compressed[1:]))
+    raise ValueError(f"Unknown compressed JSON format {data_format}")
+
+
+def compress_stream(stream):
+    """Read a binary stream in blocks and return its zlib compressed content."""
+    compressor = zlib.compressobj()
+    compressed = []
+    while True:
+        block = stream.read(READ_BLOCK_BYTES)
+        if not block:
+            break
+        compressed.append(compressor.compress(block))
+    compressed.append(compressor.flush())
+    return b''.join(compressed)
+
+
+def decompressed_blocks(blocks):
+    """
+    The content of an iterable of byte blocks, decompressed block by block as they arrive if it's gzip compressed,
+    as it is unchanged otherwise.
+    """
+    blocks = iter(blocks)
+    head = b''
+    for block in blocks:
+        head += block
+        if len(head) >= len(GZIP_MAGIC):
+            break
+    if not head.startswith(GZIP_MAGIC):
+        yield head
+        yield from blocks
+        return
+
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    yield decompressor.decompress(head)
+    for block in blocks:
+        yield decompressor.decompress(block)
+    yield decompressor.flush()
+
+
+class DecompressingStream(object):
+    """Binary stream that decompresses zlib compressed data block by block as it's read."""
+
+    def __init__(self, compressed):
+        self._compressed = compressed
+        self._position = 0
+        self._decompressor = zlib.decompressobj()
+        self._buffer = b''
+        self._finished = False
+
+    def read(self, size=-1):
+        while (size is None or size < 0 or len(self._buffer) < size) and not self._finished:
+            block = self._compressed[self._position:self._position + READ_BLOCK_BYTES]
+            self._position += len(block)
+            if block:
+                self._buffer += self._decompressor.decompress(block)
+            else:
+                self._buffer += self._decompressor.flush()
+                self._finished = True
+
+        if size is None or size < 0:
+            data, self._buffer = self._buffer, b''
+        else:
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
+class JSONStream(object):
+    """
+    JSON encoding of data as an iterable of byte blocks with a length, so requests can upload it with a Content-Length
+    without the encoding ever being completely in memory. Getting the length encodes the data once without keeping it,
+    iterating encodes it again. With gzip=True the blocks are gzip compressed, which gives the same bytes both times.
+    """
+
+    def __init__(self, data, gzip=False):
+        self._data = data
+        self._gzip = gzip
+        self._length = None
+
+    def __iter__(self):
+        compressor = zlib.compressobj(ZLIB_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS) if self._gzip else None
+        parts = []
+        parts_size = 0
+        for part in self._encode():
+            parts.append(part)
+            parts_size += len(part)
+            if parts_size >= READ_BLOCK_BYTES:
+                block = ''.join(parts).encode('utf-8')
+                parts = []
+                parts_size = 0
+                if compressor is not None:
+                    block = compressor.compress(block)
+                if block:
+                    yield block
+
+        block = ''.join(parts).encode('utf-8')
+        if compressor is not None:
+            block = compressor.compress(block) + compressor.flush()
+        if block:
+            yield block
+
+    def _encode(self):
+        if not isinstance(self._data, list):
+            yield from json.JSONEncoder().iterencode(self._data)
+            return
+        # Same output as json.dumps. iterencode doesn't use the C encoder, so encode slices of items with json.dumps instead
+        yield '['
+        for start in range(0, len(self._data), JSON_STREAM_ITEMS_PER_SLICE):
+            if start > 0:
+                yield ', '
+            yield json.dumps(self._data[start:start + JSON_STREAM_ITEMS_PER_SLICE])[1:-1]
+        yield ']'
+
+    def __len__(self):
+        if self._length is None:
+            self._length = sum(len(block) for block in self)
+        return self._length
@@ -1,18 +1,50 @@
 MAX_FILE_BYTES = 256000000  # 256 MB
 
 GARMIN_HEALTH_API_TAG = 'garmin-health-api'
+GARMIN_HEALTH_API_DELTA_TAG = 'garmin-health-api-delta'  # Delta files of a monthly file, see SUMMARIES_FILE_LAYOUT
+GARMIN_HEALTH_API_GZIP_TAG = 'garmin-health-api-gzip'  # Files that are gzip compressed, see SUMMARIES_FILE_FORMAT
 
 BACKFILL_MIN_YEAR = 2015  # that's when the smart watches with tracking capabilities came out
 BACKFILL_SECONDS = 7776000  # Maximum allowed by the API (90 days)
 BACKFILL_SLEEP_BETWEEN_CALLS = 10  # Don't decrease this, it seems to make Garmin to ignore some of our backfill requests
+BACKFILL_MAX_EMPTY_WINDOWS = 4  # Stop backfilling a data type after this many windows older than all the data Garmin pushed for it
+BACKFILL_EMPTY_GRACE_SECONDS = 3600  # Time Garmin gets to push the data of the last window before we conclude it's empty
 
+SUMMARIES_CHUNK_SIZE = 1000  # Pushed summaries are parsed and saved for processing in chunks of at most this many summaries
+SUMMARIES_MAX_BUFFERED = 10000  # All chunks are saved once this many summaries are buffered
+
+SUMMARIES_LEASE_SECONDS = 300  # Claims of a worker process that stopped sending heartbeats are released after this time
+SUMMARIES_HEARTBEAT_SECONDS = 60
+
+SUMMARIES_RETRY_COUNTDOWN = 60  # Summaries that failed to process are retried after this many seconds, doubling with every failure up to the max
+SUMMARIES_MAX_RETRY_COUNTDOWN = 3600
+BACKFILL_RETRY_COUNTDOWN = 600  # A failed backfill call is retried after this, doubling with every failure up to the max
+BACKFILL_MAX_RETRY_COUNTDOWN = 21600
+
+WORKER_IDLE_MIN_SLEEP = 0.5  # Idle workers double their sleep from min to max, but wake up immediately when notified
+WORKER_IDLE_MAX_SLEEP = 30
+WORKER_IDLE_MAX_SLEEP_WITHOUT_NOTIFY = 4  # Databases without LISTEN/NOTIFY can't wake up workers in another process
+
+# In order of priority, the most valuable data types are requested first for the same window
 GARMIN_BACKFILL_URLS = [
     'https://healthapi.garmin.com/wellness-api/rest/backfill/dailies',
-    'https://healthapi.garmin.com/wellness-api/rest/backfill/epochs',
     'https://healthapi.garmin.com/wellness-api/rest/backfill/sleeps',
-    'https://healthapi.garmin.com/wellness-api/rest/backfill/bodyComps',
+    'https://healthapi.garmin.com/wellness-api/rest/backfill/epochs',
     'https://healthapi.garmin.com/wellness-api/rest/backfill/stressDetails',
+    'https://healthapi.garmin.com/wellness-api/rest/backfill/bodyComps',
     'https://healthapi.garmin.com/wellness-api/rest/backfill/userMetrics',
     'https://healthapi.garmin.com/wellness-api/rest/backfill/pulseOx',
     'https://healthapi.garmin.com/wellness-api/rest/backfill/respiration',
 ]
+
+# Data type (see RetrievedData) of the summaries Garmin pushes for every backfill endpoint
+GARMIN_BACKFILL_DATA_TYPES = {
+    'dailies': 'dailies',
+    'sleeps': 'sleep',
+    'epochs': 'epochs',
+    'stressDetails': 'stress',
+    'bodyComps': 'body-composition',
+    'userMetrics': 'user-metrics',
+    'pulseOx': 'pulse-ox',
+    'respiration': 'respiration',
+}
@@ -8,7 +8,14 @@ from requests_oauthlib import OAuth1Session
 from requests.exceptions import ReadTimeout, RequestException
 
 import json
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from itertools import islice
+
+from .http_pool import oauth1_session
+from .retry import RetryPolicy
 
 
 def timestamp_calculator(nro_days_ago=1):
@@ -19,6 +26,19 @@ def timestamp_calculator(nro_days_ago=1):
     return start_time, end_time
 
 
+def query_chunks(start_time, end_time):
+    """Split a time range in seconds into ranges the API accepts."""
+    chunk_start = start_time
+    while chunk_start < end_time:
+        chunk_end = min(chunk_start + MAX_QUERY_SECONDS, end_time)
+        yield chunk_start, chunk_end
+        chunk_start = chunk_end
+
+
+def summary_url(url, start_time, end_time):
+    return '{0}uploadStartTimeInSeconds={1}&uploadEndTimeInSeconds={2}'.format(url, start_time, end_time)
+
+
 def save_json_data(data, filename):
     """Save JSON data to a given filename."""
     try:
@@ -51,6 +71,7 @@ API_USER_ID = "{0}/user/id".format(API_URL)
 
 # Garmin Health Constants
 RETRY = 3
+MAX_QUERY_SECONDS = 86400  # Garmin rejects upload time ranges of more than 24hrs
 
 CONFIG_DATA = {
     'client_key': None,
@@ -160,7 +181,7 @@ class GarminHealth(object):
 
         """
 
-        self.oauth = OAuth1Session(
+        self.oauth = oauth1_session(
             client_key=self._consumer_key,
             client_secret=self._consumer_secret)
 
@@ -187,7 +208,7 @@ class GarminHealth(object):
 
         oauth_response = throwaway_oauth.parse_authorization_response(redirect_response)
 
-        self.oauth = OAuth1Session(
+        self.oauth = oauth1_session(
             client_key=self._consumer_key,
             client_secret=self._consumer_secret,
             resource_owner_key=oauth_response['oauth_token'],
@@ -213,50 +234,52 @@ class GarminHealth(object):
         else:
             raise Exception("No user access token available")
 
-    def query(self, url, method='GET', retry=RETRY, raw=False):
+    def query(self, url, method='GET', retry=RETRY, raw=False, retry_policy=None, oauth=None):
         """
         Method to query the Garmin Health API.
 
         :param method: define the HTTP method
         :param raw: define if a requests raw object will be returned
-        :param retry: number of attempts in case of failure
+        :param retry: number of retries in case of failure
+        :param retry_policy: when to retry, defaults to backoff with `retry` retries
+        :param oauth: session to send the request with, defaults to self.oauth
         :type method: string
         :type raw: boolean
         :type retry: integer
+        :type retry_policy: main.retry.RetryPolicy
+        :type oauth: requests_oauthlib.OAuth1Session
         """
         # make sure oauth token is present
         if not self.authorized:
             _LOGGER.debug("OAuth token not valid, trying to fetch a new one")
             self.__fetch_oauth_token()
 
-        loop = 0
+        if retry_policy is None:
+            retry_policy = RetryPolicy('garmin', max_attempts=retry + 1)
+        oauth = oauth or self.oauth
+
         try:
-            while loop <= retry:
-                loop += 1
-
-                if method.lower() == 'get':
-                    _LOGGER.debug("Querying %s", url)
-                    resp = self.oauth.get(url)
-
-                # in case of a problem
-                if not resp:
-                    if resp.status_code == 403:
-                        msg = "Invalid OAuth1 Token. Consider refreshing it!!"
-                        raise GarminHealthFatalException(msg)
-
-                # if everything worked as expected
-                if resp.status_code == 200:
-                    # print(resp.content)
-                    if raw:
-                        return resp
-                    else:
-                        return resp.json()
+            _LOGGER.debug("Querying %s", url)
+            resp = retry_policy.call(lambda: oauth.request(method, url))
 
         # threat exceptions
         except (ReadTimeout, RequestException) as error_msg:
             _LOGGER.error("Error: %s", error_msg)
+            raise GarminHealthFatalException("Something went wrong!!!")
+
+        # in case of a problem
+        if resp.status_code == 403:
+            msg = "Invalid OAuth1 Token. Consider refreshing it!!"
+            raise GarminHealthFatalException(msg)
 
-        # if we haven't left the method yet, throw ops!
+        # if everything worked as expected
+        if resp.status_code == 200:
+            if raw:
+                return resp
+            else:
+                return resp.json()
+
+        _LOGGER.error("Error: got response %s for %s", resp.status_code, url)
         raise GarminHealthFatalException("Something went wrong!!!")
 
     @property
@@ -267,35 +290,68 @@ class GarminHealth(object):
         except AttributeError:
             return False
 
+    def copy_oauth_session(self):
+        """A new session with the credentials of self.oauth, for use in another thread. It shares the connection pool."""
+        client = self.oauth._client.client
+        return oauth1_session(client_key=client.client_key, client_secret=client.client_secret,
+                              resource_owner_key=client.resource_owner_key, resource_owner_secret=client.resource_owner_secret)
+
     def _summary(self, url, filename, start_time=None, end_time=None):
         # defaults to the last 24hrs
         if start_time is None and end_time is None:
             start_time, end_time = timestamp_calculator()
 
-        endpoint = '{0}uploadStartTimeInSeconds={1}&uploadEndTimeInSeconds={2}'.format(url, start_time, end_time)
-        data = self.query(endpoint)
-        return data
+        return list(self.iter_summaries(url, start_time, end_time))
+
+    def iter_summaries(self, url, start_time, end_time, max_workers=4):
+        """
+        Yield the summaries uploaded between start_time and end_time, in any range.
+
+        The range is queried in chunks of at most MAX_QUERY_SECONDS, in order, by max_workers threads. At most max_workers
+        chunks are fetched ahead of the caller, so a long range is never in memory at once.
+        """
+        chunks = query_chunks(start_time, end_time)
+        local = threading.local()
+
+        def query_chunk(chunk_start, chunk_end):
+            # OAuth1Session isn't thread-safe, every thread signs its requests with its own copy
+            if not hasattr(local, 'oauth'):
+                local.oauth = self.copy_oauth_session()
+            return self.query(summary_url(url, chunk_start, chunk_end), oauth=local.oauth)
+
+        with ThreadPoolExecutor(max_workers) as executor:
+            pending = deque(executor.submit(query_chunk, *chunk) for chunk in islice(chunks, max_workers))
+            try:
+                while pending:
+                    data = pending.popleft().result()
+                    next_chunk = next(chunks, None)
+                    if next_chunk is not None:
+                        pending.append(executor.submit(query_chunk, *next_chunk))
+                    yield from data
+            finally:
+                for future in pending:
+                    future.cancel()
 
     def daily_summary(self, start_time=None, end_time=None):
-        return self._summary(API_DAILIES, 'dailies')
+        return self._summary(API_DAILIES, 'dailies', start_time, end_time)
 
     def activity_summary(self, start_time=None, end_time=None):
-        return self._summary(API_ACTIVITIES, 'activities')
+        return self._summary(API_ACTIVITIES, 'activities', start_time, end_time)
 
     def sleep_summary(self, start_time=None, end_time=None):
-        return self._summary(API_SLEEPS, 'sleep')
+        return self._summary(API_SLEEPS, 'sleep', start_time, end_time)
 
     def body_summary(self, start_time=None, end_time=None):
-        return self._summary(API_BODY, 'body')
+        return self._summary(API_BODY, 'body', start_time, end_time)
 
     def stress_summary(self, start_time=None, end_time=None):
-        return self._summary(API_STRESS, 'stress')
+        return self._summary(API_STRESS, 'stress', start_time, end_time)
 
     def user_metrics(self, start_time=None, end_time=None):
-        return self._summary(API_USER_METRICS, 'userMetrics')
+        return self._summary(API_USER_METRICS, 'userMetrics', start_time, end_time)
 
     def moveiq(self, start_time=None, end_time=None):
-        return self._summary(API_MOVEIQ, 'moveIQ')
+        return self._summary(API_MOVEIQ, 'moveIQ', start_time, end_time)
 
     @property
     def api_id(self):
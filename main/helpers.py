@@ -1,3 +1,5 @@
+import hashlib
+import itertools
 import json
 import logging
 import os
@@ -5,68 +7,245 @@ import tempfile
 from collections import defaultdict
 from datetime import datetime
 
-import requests
+from urllib import parse
+
+import ijson
+from django.conf import settings
+from django.db.models import F
 from ohapi import api
 
-from main.consts import MAX_FILE_BYTES, GARMIN_HEALTH_API_TAG
+from main import metrics
+from main.compression import READ_BLOCK_BYTES, JSONStream, decompressed_blocks
+from main.consts import MAX_FILE_BYTES, GARMIN_HEALTH_API_TAG, GARMIN_HEALTH_API_DELTA_TAG, GARMIN_HEALTH_API_GZIP_TAG
+from main.http_pool import get_session
 from main.models import GarminMember
+from main.month_buckets import month_names, summary_epochs
+from main.member_files_cache import MemberFilesCache
+from main.summaries_cache import SummariesCache
 
 epoch = datetime.utcfromtimestamp(0)
 
 _LOGGER = logging.getLogger(__name__)
 
+summaries_cache = SummariesCache(settings.SUMMARIES_CACHE_DIR, settings.SUMMARIES_CACHE_MAX_BYTES)
+member_files_cache = MemberFilesCache(settings.OH_FILES_CACHE_SECONDS)
+
 
 def unix_time_seconds(dt):
     return int((dt - epoch).total_seconds())
 
 
-def write_json_data_to_tmp_file(filename, json_data):
-    tmp_dir = tempfile.mkdtemp()
-    full_path = os.path.join(tmp_dir, filename)
-    with open(full_path, 'w') as json_file:
-        json_file.write(json.dumps(json_data))
-        json_file.flush()
-    return tmp_dir, full_path
-
-
 def find_existing_data_file(oh_user_data, file_name):
     for file in oh_user_data['data']:
         tags = file['metadata']['tags']
-        if tags and GARMIN_HEALTH_API_TAG in tags and file_name in tags:
+        if tags and GARMIN_HEALTH_API_TAG in tags and file_name in tags and GARMIN_HEALTH_API_DELTA_TAG not in tags:
             return file
 
     return None  # Not found
 
 
+def find_delta_files(oh_user_data, file_name):
+    """The delta files of file_name, newest first."""
+    deltas = []
+    for file in oh_user_data['data']:
+        tags = file['metadata']['tags']
+        if tags and GARMIN_HEALTH_API_DELTA_TAG in tags and file_name in tags:
+            deltas.append(file)
+    return sorted(deltas, key=lambda delta: delta['metadata']['sequence'], reverse=True)
+
+
+def data_file_name(file):
+    """The file name (like dailies-2021-04) of a base or delta file on Open Humans, None for other files."""
+    tags = file['metadata']['tags'] or []
+    if GARMIN_HEALTH_API_TAG not in tags:
+        return None
+    for tag in tags:
+        if tag not in (GARMIN_HEALTH_API_TAG, GARMIN_HEALTH_API_DELTA_TAG, GARMIN_HEALTH_API_GZIP_TAG):
+            return tag
+    return None
+
+
+def file_format(file):
+    """The SUMMARIES_FILE_FORMAT of a file on Open Humans."""
+    return 'gzip' if GARMIN_HEALTH_API_GZIP_TAG in (file['metadata']['tags'] or []) else 'json'
+
+
+def with_file_format(basename, metadata, file_format):
+    """The basename and a copy of the metadata of a file, changed to file_format."""
+    tags = [tag for tag in metadata['tags'] if tag != GARMIN_HEALTH_API_GZIP_TAG]
+    basename = basename[:-len('.gz')] if basename.endswith('.gz') else basename
+    if file_format == 'gzip':
+        tags.append(GARMIN_HEALTH_API_GZIP_TAG)
+        basename += '.gz'
+    return basename, {**metadata, 'tags': tags}
+
+
+def download_summaries(file):
+    """
+    The summaries in a file on Open Humans. Compressed files are decompressed while they are downloaded, but the body is
+    parsed as a whole: the summaries take several times its size in memory anyway, and json.loads parses ~3x faster than ijson.
+    """
+    with get_session().get(file['download_url'], stream=True) as response:
+        return json.loads(b''.join(decompressed_blocks(response.iter_content(READ_BLOCK_BYTES))))
+
+
+def read_summaries(oh_user_data, file_name):
+    """All summaries of file_name on Open Humans, merging the monthly file with its delta files."""
+    existing_file = find_existing_data_file(oh_user_data, file_name)
+    summaries = download_summaries(existing_file) if existing_file else []
+    for delta in reversed(find_delta_files(oh_user_data, file_name)):
+        summaries = merge_summaries(download_summaries(delta), summaries)
+    return summaries
+
+
 def merge_summaries(new_summaries, old_summaries):
+    """The new summaries followed by the old ones they don't replace. The first summary with a summaryId wins."""
     result = []
     seen_summary_ids = set()
-    for summary in new_summaries + old_summaries:
-        summary_id = summary['summaryId']
-        if summary_id not in seen_summary_ids:
-            result.append(summary)
-            seen_summary_ids.add(summary_id)
+    for summaries in (new_summaries, old_summaries):
+        for summary in summaries:
+            summary_id = summary['summaryId']
+            if summary_id not in seen_summary_ids:
+                result.append(summary)
+                seen_summary_ids.add(summary_id)
     return result
 
 
-def merge_with_existing_and_upload(oh_user, summaries, file_name):
+def summary_digest(summary):
+    return hashlib.blake2b(json.dumps(summary, sort_keys=True).encode(), digest_size=8).digest()
+
+
+def summaries_index(summaries):
+    """summaryId -> digest of the summaries, the first summary with a summaryId wins like in merge_summaries."""
+    index = {}
+    for summary in summaries:
+        index.setdefault(summary['summaryId'], summary_digest(summary))
+    return index
+
+
+def is_contained(index, summaries_index):
+    """Whether all summaries of summaries_index are in the index, unchanged."""
+    return all(index.get(summary_id) == digest for summary_id, digest in summaries_index.items())
+
+
+def save_summaries(oh_user, summaries, file_name):
+    """Save new summaries of file_name on Open Humans, in the layout of SUMMARIES_FILE_LAYOUT. Returns the saved summaries."""
     access_token = oh_user.get_access_token()
-    oh_user_data = api.exchange_oauth2_member(access_token)
+    try:
+        if settings.SUMMARIES_FILE_LAYOUT == 'delta':
+            return append_delta_and_upload(oh_user, access_token, summaries, file_name)
+        return merge_with_existing_and_upload(oh_user, access_token, summaries, file_name)
+    except Exception:
+        # The files on Open Humans might have changed halfway, make every process list them again
+        member_files_cache.invalidate(oh_user.oh_id)
+        files_changed(oh_user)
+        raise
+
+
+def get_member_files(oh_user, access_token, refresh=False):
+    """The listing of the files of the member on Open Humans, like exchange_oauth2_member, from the member_files_cache."""
+    fetch = lambda: exchange_oauth2_member(access_token)  # noqa: E731
+    version = files_version(oh_user)
+    if refresh:
+        return member_files_cache.refresh(oh_user.oh_id, version, fetch)
+    return member_files_cache.get(oh_user.oh_id, version, fetch)
+
+
+def files_version(oh_user):
+    return GarminMember.objects.values_list('files_version', flat=True).get(member=oh_user)
+
+
+def files_changed(oh_user):
+    """Record that the files of the member on Open Humans changed, see MemberFilesCache. Returns the new files_version."""
+    GarminMember.objects.filter(member=oh_user).update(files_version=F('files_version') + 1)
+    return files_version(oh_user)
+
+
+def merge_with_existing_and_upload(oh_user, access_token, summaries, file_name):
+    """Rewrite the monthly file with the new summaries. Delta files of the month are merged into it and removed."""
+    oh_user_data = get_member_files(oh_user, access_token)
     existing_file = find_existing_data_file(oh_user_data, file_name)
+    deltas = find_delta_files(oh_user_data, file_name)
+    new_index = summaries_index(summaries) if summaries_cache.enabled else None
+    old_index = summaries_cache.get_index(oh_user.oh_id, file_name, existing_file['id']) if existing_file and len(deltas) == 0 else None
+    if old_index is not None and is_contained(old_index, new_index):
+        skip_unchanged_upload(oh_user, summaries, file_name, existing_file)
+        return summaries
+
+    old_summaries = summaries_cache.get(oh_user.oh_id, file_name, existing_file['id']) if existing_file else []
+    if any(file['download_url'] is None for file in deltas + ([existing_file] if old_summaries is None else [])):
+        # We uploaded these files ourselves, only a new listing has their download urls
+        oh_user_data = get_member_files(oh_user, access_token, refresh=True)
+        existing_file = find_existing_data_file(oh_user_data, file_name)
+        deltas = find_delta_files(oh_user_data, file_name)
+
+    new_summaries = [summaries] + [download_summaries(delta) for delta in deltas]  # Newest first
     if existing_file:
-        download_url = existing_file['download_url']
-        old_summaries = json.loads(requests.get(download_url).content)
-        summaries = merge_summaries(summaries, old_summaries)
-    else:
-        summaries = merge_summaries(summaries, [])  # Remove duplicates
+        if old_summaries is None:
+            old_summaries = download_summaries(existing_file)
+        if len(deltas) == 0 and is_unchanged(summaries, old_summaries):
+            if summaries_cache.enabled:
+                # So the next batch can be checked against the index without downloading the file
+                summaries_cache.put(oh_user.oh_id, file_name, existing_file['id'], old_summaries, summaries_index(old_summaries))
+            skip_unchanged_upload(oh_user, summaries, file_name, existing_file)
+            return summaries
+    summaries = merge_summaries(itertools.chain.from_iterable(new_summaries), old_summaries)
     existing_file_id = existing_file['id'] if existing_file else None
 
     _LOGGER.info(f"Uploading {len(summaries)} summaries to file {file_name} for user {oh_user.oh_id}")
-    upload_summaries(oh_user, summaries, file_name, existing_file_id)
+    try:
+        file_id = upload_summaries(oh_user, access_token, summaries, file_name, existing_file_id)
+        if summaries_cache.enabled:
+            # Only the new summaries need a digest, unless there was no index
+            index = {**old_index, **new_index} if old_index is not None else summaries_index(summaries)
+            summaries_cache.put(oh_user.oh_id, file_name, file_id, summaries, index)
+    except Exception:
+        summaries_cache.invalidate(oh_user.oh_id, file_name)
+        raise
+
+    if len(deltas) > 0:
+        for delta in deltas:
+            delete_file(access_token, oh_user.oh_id, delta['id'])
+        member_files_cache.update(oh_user.oh_id, files_changed(oh_user), removed_ids=[delta['id'] for delta in deltas])
+        metrics.increment('summaries_deltas_compacted', len(deltas))
 
     return summaries
 
 
+def is_unchanged(new_summaries, old_summaries):
+    """Whether all new summaries are in old_summaries already, unchanged."""
+    old_summaries_by_id = {summary['summaryId']: summary for summary in old_summaries}
+    return all(old_summaries_by_id.get(summary['summaryId']) == summary for summary in new_summaries)
+
+
+def skip_unchanged_upload(oh_user, summaries, file_name, existing_file):
+    # Garmin often pushes summaries again, uploading the same file and deleting the old one would be a waste
+    _LOGGER.info(f"Skipping {len(summaries)} summaries that are already in file {file_name} for user {oh_user.oh_id}")
+    metrics.increment('summaries_uploads_avoided')
+    metrics.increment('summaries_upload_bytes_avoided', existing_file['metadata'].get('size_bytes', 0))
+    metrics.increment('summaries_deletes_avoided')
+
+
+def append_delta_and_upload(oh_user, access_token, summaries, file_name):
+    """
+    Upload the new summaries as a small delta file next to the monthly file, instead of rewriting the monthly file.
+    Once the deltas of the month exceed SUMMARIES_DELTA_MAX_FILES or SUMMARIES_DELTA_MAX_SUMMARIES, they are compacted
+    into the monthly file together with the new summaries. Returns the new summaries.
+    """
+    deltas = find_delta_files(get_member_files(oh_user, access_token), file_name)
+    delta_summaries = sum(delta['metadata']['summaries_count'] for delta in deltas) + len(summaries)
+    if len(deltas) + 1 > settings.SUMMARIES_DELTA_MAX_FILES or delta_summaries > settings.SUMMARIES_DELTA_MAX_SUMMARIES:
+        merge_with_existing_and_upload(oh_user, access_token, summaries, file_name)
+        return summaries
+
+    summaries = merge_summaries(summaries, [])  # Remove duplicates
+    sequence = deltas[0]['metadata']['sequence'] + 1 if len(deltas) > 0 else 1
+    _LOGGER.info(f"Uploading {len(summaries)} summaries to delta {sequence} of file {file_name} for user {oh_user.oh_id}")
+    upload_summaries(oh_user, access_token, summaries, file_name, None, delta_sequence=sequence)
+    metrics.increment('summaries_deltas_uploaded')
+    return summaries
+
+
 def remove_unwanted_fields(summaries):
     remove_fields(summaries, ['userId', 'userAccessToken'])  # No need to store this data in every single summary
 
@@ -78,13 +257,90 @@ def remove_fields(summaries, fields_to_remove):
                 del summary[field]
 
 
-def upload_summaries(oh_user, summaries, file_name, existing_file_id):
-    temp_dir, file = write_json_data_to_tmp_file(f'garmin-health-api-{file_name}.json', summaries)
-    api.upload_aws(file, create_metadata(file_name), oh_user.get_access_token(), project_member_id=oh_user.oh_id, max_bytes=MAX_FILE_BYTES)
+def upload_summaries(oh_user, access_token, summaries, file_name, existing_file_id, delta_sequence=None):
+    """
+    Upload the summaries to Open Humans, replacing the file with existing_file_id. Returns the id of the new file.
+    With a delta_sequence the summaries are uploaded as that delta file of file_name.
+    """
+    if delta_sequence is None:
+        basename, metadata = f'garmin-health-api-{file_name}.json', create_metadata(file_name)
+    else:
+        basename, metadata = f'garmin-health-api-{file_name}.delta-{delta_sequence}.json', create_delta_metadata(file_name, delta_sequence, len(summaries))
+    return upload_summaries_file(oh_user, access_token, summaries, basename, metadata, existing_file_id)
+
+
+def upload_summaries_file(oh_user, access_token, summaries, basename, metadata, existing_file_id, file_format=None):
+    """
+    Upload the summaries as basename with metadata in file_format (SUMMARIES_FILE_FORMAT by default), replacing the file
+    with existing_file_id. Returns the id of the new file.
+    """
+    basename, metadata = with_file_format(basename, metadata, file_format or settings.SUMMARIES_FILE_FORMAT)
+    body = JSONStream(summaries, gzip=GARMIN_HEALTH_API_GZIP_TAG in metadata['tags'])
+    metadata['size_bytes'] = len(body)
+    file_id = upload_stream(body, basename, metadata, access_token, oh_user.oh_id)
     if existing_file_id:
-        api.delete_file(oh_user.get_access_token(), file_id=existing_file_id)
-    os.remove(file)
-    os.rmdir(temp_dir)
+        delete_file(access_token, oh_user.oh_id, existing_file_id)
+    member_files_cache.update(oh_user.oh_id, files_changed(oh_user), added=[{'id': file_id, 'basename': basename, 'metadata': metadata, 'download_url': None}],
+                              removed_ids=[existing_file_id] if existing_file_id else [])
+    return file_id
+
+
+def reencode_file(oh_user, access_token, file, file_format):
+    """Upload a summary file on Open Humans again in file_format and remove the original. Returns the id of the new file."""
+    summaries = download_summaries(file)
+    return upload_summaries_file(oh_user, access_token, summaries, file['basename'], file['metadata'], file['id'], file_format)
+
+
+def upload_stream(body, filename, metadata, access_token, project_member_id, max_bytes=MAX_FILE_BYTES):
+    """
+    Upload bytes, or an iterable of bytes with a length like JSONStream, with the "direct upload" API of Open Humans.
+    Does the same as `ohapi.api.upload_stream`, but returns the id of the uploaded file.
+    """
+    filesize = len(body)
+    if filesize > max_bytes:
+        raise ValueError(f"Maximum file size exceeded for {filename}: {filesize} > {max_bytes}")
+
+    query = parse.urlencode({'access_token': access_token})
+    session = get_session()
+    upload_response = session.post(parse.urljoin(api.OH_BASE_URL, f'/api/direct-sharing/project/files/upload/direct/?{query}'), data={
+        'project_member_id': project_member_id,
+        'metadata': json.dumps(metadata),
+        'filename': filename,
+    })
+    api.handle_error(upload_response, 201)
+    file_id = upload_response.json()['id']
+
+    api.handle_error(session.put(url=upload_response.json()['url'], data=body), 200)
+
+    complete_response = session.post(parse.urljoin(api.OH_BASE_URL, f'/api/direct-sharing/project/files/upload/complete/?{query}'), data={
+        'project_member_id': project_member_id,
+        'file_id': file_id,
+    })
+    api.handle_error(complete_response, 200)
+    return file_id
+
+
+def exchange_oauth2_member(access_token):
+    """Same as `ohapi.api.exchange_oauth2_member`, over the shared connection pool."""
+    session = get_session()
+    url = parse.urljoin(api.OH_BASE_URL, f"/api/direct-sharing/project/exchange-member/?{parse.urlencode({'access_token': access_token})}")
+    response = session.get(url)
+    api.handle_error(response, 200)
+    member_data = response.json()
+    result = member_data.copy()
+    while member_data['next']:
+        response = session.get(member_data['next'])
+        api.handle_error(response, 200)
+        member_data = response.json()
+        result['data'] = result['data'] + member_data['data']
+    return result
+
+
+def delete_file(access_token, project_member_id, file_id):
+    """Same as `ohapi.api.delete_file`, over the shared connection pool."""
+    url = parse.urljoin(api.OH_BASE_URL, f"/api/direct-sharing/project/files/delete/?{parse.urlencode({'access_token': access_token})}")
+    response = get_session().post(url, data={'project_member_id': project_member_id, 'file_id': file_id})
+    api.handle_error(response, 200)
 
 
 def get_django_user_id_from_garmin_id(garmin_user_id):
@@ -105,72 +361,84 @@ def create_metadata(file_name):
     }
 
 
-def extract_timestamp(summary):
-    if "startTimeInSeconds" in summary:
-        # Used in almost all types of summaries
-        return datetime.fromtimestamp(summary["startTimeInSeconds"])
-    if "measurementTimeInSeconds" in summary:
-        # Used for body composition
-        return datetime.fromtimestamp(summary["measurementTimeInSeconds"])
-    if "calendarDate" in summary:
-        # Used for user metrics
-        return datetime.strptime(summary['calendarDate'], '%Y-%m-%d')
-
-    raise Exception(f"Failed to find timestamp field in summary. Found keys {summary.keys()}")
+def create_delta_metadata(file_name, sequence, summaries_count):
+    return {
+        'description': f'Garmin Health API data {file_name}, part {sequence} of the changes since the monthly file',
+        'tags': [GARMIN_HEALTH_API_TAG, GARMIN_HEALTH_API_DELTA_TAG, file_name],
+        'sequence': sequence,
+        'summaries_count': summaries_count,
+        'updated_at': str(datetime.utcnow()),
+    }
 
 
 def group_summaries_per_user_and_per_month(summaries):
     result = defaultdict(lambda: defaultdict(lambda: []))
 
-    for summary in summaries:
-        garmin_user_id = summary['userId']
-        month = month_name(extract_timestamp(summary))
-        result[garmin_user_id][month].append(summary)
+    for summary, month in zip(summaries, month_names(summary_epochs(summaries))):
+        result[summary['userId']][month].append(summary)
 
     return result
 
 
-def month_name(timestamp):
-    return timestamp.strftime("%Y-%m")
+def iter_summaries(stream, summary_name):
+    """
+    Incrementally parse the summaries from the body of a Garmin push notification.
+    The body is read from the stream in small blocks, so it's never completely in memory.
+    """
+    keys = []
 
+    def record_keys(events):
+        # The top-level keys can come after the summaries, so they are recorded while the body is parsed
+        for prefix, event, value in events:
+            if prefix == '' and event == 'map_key':
+                keys.append(value)
+            yield prefix, event, value
 
-def extract_summaries(request_body, summary_name):
-    json_body = json.loads(request_body)
-    if summary_name not in json_body:
-        raise Exception(f'Could not find summaries with name {summary_name}')
+    yield from ijson.items(record_keys(ijson.parse(stream, use_float=True)), f'{summary_name}.item')
 
-    summaries = json_body[summary_name]
-    other_keys = [key for key in json_body.keys() if key != summary_name]
+    if summary_name not in keys:
+        raise Exception(f'Could not find summaries with name {summary_name}')
+    other_keys = [key for key in keys if key != summary_name]
     if len(other_keys) > 0:
         logging.warning(f'Found ignored keys {other_keys} in summary file')
-    return summaries
 
 
-def summaries_to_process_key(summaries_to_process):
-    return f"{summaries_to_process.garmin_user_id}_{summaries_to_process.file_name}"
+def iter_batches(iterable, batch_size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
 
 
 def remove_all_oh_data_files_for_user(garmin_user_id):
     oh_user = get_oh_user_from_garmin_id(garmin_user_id)
-    oh_user_data = api.exchange_oauth2_member(oh_user.get_access_token())
+    access_token = oh_user.get_access_token()
+    oh_user_data = exchange_oauth2_member(access_token)
     for file in oh_user_data['data']:
         _LOGGER.info(f"Removing file {file}")
-        api.delete_file(oh_user.get_access_token(), file_id=file['id'])
+        delete_file(access_token, oh_user.oh_id, file['id'])
+    member_files_cache.invalidate(oh_user.oh_id)
+    files_changed(oh_user)
 
 
 def download_all_oh_data_files_for_user(garmin_user_id):
     oh_user = get_oh_user_from_garmin_id(garmin_user_id)
-    oh_user_data = api.exchange_oauth2_member(oh_user.get_access_token())
+    oh_user_data = exchange_oauth2_member(oh_user.get_access_token())
     tmp_dir = tempfile.mkdtemp()
     _LOGGER.info(f"Downloading all summaries to {tmp_dir}")
     summary_ids = []
-    for file in oh_user_data['data']:
-        _LOGGER.info(f"Downloading file {file['basename']}")
-        download_url = file['download_url']
-        summaries = json.loads(requests.get(download_url).content)
+    file_names = sorted(set(filter(None, map(data_file_name, oh_user_data['data']))))
+    for file_name in file_names:
+        basename = f'garmin-health-api-{file_name}.json'
+        _LOGGER.info(f"Downloading file {basename}")
+        summaries = read_summaries(oh_user_data, file_name)
         for summary in summaries:
-            summary_ids.append(f"{file['basename']}_{summary['summaryId']}")
-        full_path = os.path.join(tmp_dir, file['basename'])
+            summary_ids.append(f"{basename}_{summary['summaryId']}")
+        full_path = os.path.join(tmp_dir, basename)
         with open(full_path, 'w') as json_file:
             json_file.write(json.dumps(summaries, indent=4))
             json_file.flush()
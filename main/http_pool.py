@@ -0,0 +1,98 @@
+"""
+Shared pool of keep-alive HTTP connections for the calls to Garmin and Open Humans.
+All sessions mount the same adapter, so a connection opened by one call is reused by the next call to the same host.
+"""
+import os
+import threading
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from requests_oauthlib import OAuth1Session
+from urllib3 import HTTPConnectionPool, HTTPSConnectionPool
+
+from . import metrics
+
+
+class CountingHTTPConnectionPool(HTTPConnectionPool):
+    """Counts the connections opened and the requests made, the other requests reused a connection."""
+
+    def _new_conn(self):
+        metrics.increment('http_connections_opened')
+        return super()._new_conn()
+
+    def urlopen(self, *args, **kwargs):
+        metrics.increment('http_requests')
+        return super().urlopen(*args, **kwargs)
+
+
+class CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    def _new_conn(self):
+        metrics.increment('http_connections_opened')
+        return super()._new_conn()
+
+    def urlopen(self, *args, **kwargs):
+        metrics.increment('http_requests')
+        return super().urlopen(*args, **kwargs)
+
+
+class PooledHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter with a default timeout and counting connection pools."""
+
+    def __init__(self, timeout, **kwargs):
+        self.timeout = timeout
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {'http': CountingHTTPConnectionPool, 'https': CountingHTTPSConnectionPool}
+
+    def send(self, request, timeout=None, **kwargs):
+        return super().send(request, timeout=timeout or self.timeout, **kwargs)
+
+
+_adapter = None
+_adapter_lock = threading.Lock()
+_local = threading.local()
+
+
+def get_adapter():
+    global _adapter
+    with _adapter_lock:
+        if _adapter is None:
+            _adapter = PooledHTTPAdapter(
+                timeout=(settings.HTTP_CONNECT_TIMEOUT, settings.HTTP_READ_TIMEOUT),
+                pool_connections=settings.HTTP_POOL_HOSTS,
+                pool_maxsize=settings.HTTP_POOL_CONNECTIONS_PER_HOST,
+            )
+        return _adapter
+
+
+def mount_pool(session):
+    adapter = get_adapter()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def get_session():
+    """Session for the current thread. Sessions aren't thread-safe, the connection pool they share is."""
+    session = getattr(_local, 'session', None)
+    if session is None:
+        session = _local.session = mount_pool(requests.Session())
+    return session
+
+
+def oauth1_session(**kwargs):
+    """OAuth1Session that uses the shared connection pool."""
+    return mount_pool(OAuth1Session(**kwargs))
+
+
+def _reset_after_fork():
+    # Connections can't be shared with the parent process
+    global _adapter, _local
+    _adapter = None
+    _local = threading.local()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
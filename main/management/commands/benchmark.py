@@ -0,0 +1,313 @@
+import io
+import json
+import logging
+import queue
+import random
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+import requests
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from main import metrics, month_buckets, worker
+from main.compression import JSONStream, compress_json_string
+from main.consts import WORKER_IDLE_MIN_SLEEP
+from main.helpers import is_contained, merge_summaries, summaries_index
+from main.http_pool import get_session
+from main.models import SummariesToProcess
+from main.wakeup import next_idle_sleep, notify, notify_all_local
+from main.worker import handle_summaries_delayed, load_summaries, save_summaries_for_delayed_processing
+
+START_TIME = 1618000000
+DEFAULT_SIZES = {
+    'merge': [1000, 10000, 100000, 1000000],
+    'upload': [1000, 10000, 100000],
+    'buckets': [1000, 10000, 100000],
+    'claim': [1000, 4000],
+}
+
+
+class Command(BaseCommand):
+    help = 'Micro-benchmarks of the summary processing on synthetic data, comparing every optimization with what it replaced ' \
+           'where that still exists. Database changes are rolled back or deleted. Memory is the peak allocated by Python (tracemalloc).'
+
+    BENCHMARKS = ['merge', 'ingest', 'pending', 'http', 'upload', 'buckets', 'claim', 'wakeup']
+
+    def add_arguments(self, parser):
+        parser.add_argument('benchmarks', nargs='*', help=f"Benchmarks to run out of {', '.join(self.BENCHMARKS)}, defaults to all")
+        parser.add_argument('--sizes', type=int, nargs='+', help='Numbers of summaries for merge, upload and buckets, of pending groups for claim')
+        parser.add_argument('--payload-mb', type=int, default=50, help='Size of the push notification for ingest')
+        parser.add_argument('--rows', type=int, default=100, help='Rows of 1000 summaries for pending')
+        parser.add_argument('--requests', type=int, default=200, help='Requests for http')
+        parser.add_argument('--idle-seconds', type=float, default=10, help='Time the worker is idle for wakeup')
+        parser.add_argument('--posts', type=int, default=10, help='Push notifications for wakeup')
+
+    def handle(self, *args, **options):
+        unknown = [name for name in options['benchmarks'] if name not in self.BENCHMARKS]
+        if unknown:
+            raise CommandError(f"Unknown benchmarks {', '.join(unknown)}")
+
+        logging.disable(logging.INFO)
+        try:
+            for name in options['benchmarks'] or self.BENCHMARKS:
+                self.stdout.write(f"## {name}")
+                getattr(self, f'benchmark_{name}')(options)
+        finally:
+            logging.disable(logging.NOTSET)
+
+    def sizes(self, name, options):
+        return options['sizes'] or DEFAULT_SIZES[name]
+
+    def benchmark_merge(self, options):
+        """Merging a batch of 1000 summaries into a month, and checking a re-pushed batch against the summaryId index instead."""
+        for size in self.sizes('merge', options):
+            month = epochs(size)
+            batch = epochs(1000, first_id=size - 500)  # Half of it is new
+            repushed = month[-1000:]
+            merge_time, _ = timed(merge_summaries, batch, month)
+            index_time, index = timed(summaries_index, month)
+            check_time, contained = timed(lambda: is_contained(index, summaries_index(repushed)))
+            assert contained
+            self.stdout.write(f"{size:>9} summaries: merge {ms(merge_time)}, index the month {ms(index_time)}, "
+                              f"skip a re-pushed batch {ms(check_time)}")
+
+    def benchmark_ingest(self, options):
+        """Saving a push notification for processing by parsing it while it's read, against parsing the whole body at once."""
+        body = json.dumps({'epochs': epochs_for_bytes(options['payload_mb'] * 1024 * 1024)}).encode()
+        self.stdout.write(f"Push notification of {len(body) / 1024 / 1024:.1f} MB")
+
+        load_time, load_peak, _ = traced(json.loads, body)
+        self.stdout.write(f"json.loads of the body (the minimum without streaming): {mb(load_peak)}, {load_time:.2f} s traced")
+        with rolled_back(), override_settings(WORKER_MODE='threads'):
+            ingest_time, ingest_peak, _ = traced(handle_summaries_delayed, io.BytesIO(body), 'epochs', 'epochs')
+            rows = SummariesToProcess.objects.count()
+        self.stdout.write(f"handle_summaries_delayed: {mb(ingest_peak)}, {ingest_time:.2f} s traced, saved {rows} rows")
+
+    def benchmark_pending(self, options):
+        """Size and throughput of SummariesToProcess rows saved compressed (summaries_data) and as JSON (summaries_json)."""
+        chunk = epochs(1000)
+        for name, save in [('summaries_json', save_json_row), ('summaries_data', save_summaries_for_delayed_processing)]:
+            with rolled_back():
+                enqueue_time, _ = timed(lambda: [save('epochs-2021-04', 'benchmark', chunk) for _ in range(options['rows'])])
+                rows = list(SummariesToProcess.objects.all())
+                dequeue_time, _ = timed(lambda: [load_summaries(row) for row in rows])
+                size = sum(len(row.summaries_json.encode()) if row.summaries_json else len(row.summaries_data) for row in rows)
+            self.stdout.write(f"{name}: {mb(size)} for {options['rows']} rows, enqueue {options['rows'] / enqueue_time:.0f} rows/s, "
+                              f"dequeue {options['rows'] / dequeue_time:.0f} rows/s")
+
+    def benchmark_http(self, options):
+        """Requests to a local HTTP server through the shared connection pool, against a new session per request."""
+        server = StubServer()
+        url = f'http://127.0.0.1:{server.server_port}/'
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            for name, session in [('new session per request', requests.Session), ('shared pool', get_session)]:
+                connections = server.connections
+                duration, _ = timed(lambda: [session().get(url).content for _ in range(options['requests'])])
+                self.stdout.write(f"{name}: {options['requests'] / duration:.0f} requests/s, "
+                                  f"{server.connections - connections} connections for {options['requests']} requests")
+            self.stdout.write(f"http_connections_opened={metrics.get_counters().get('http_connections_opened', 0)}")
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def benchmark_upload(self, options):
+        """Encoding the body of an upload: json.dumps to one string, against the blocks of JSONStream."""
+        for size in self.sizes('upload', options):
+            summaries = epochs(size)
+            dumps_time, dumps_peak, _ = traced(lambda: json.dumps(summaries).encode())
+            stream_time, stream_peak, _ = traced(lambda: sum(len(block) for block in JSONStream(summaries)))
+            gzip_time, gzip_peak, _ = traced(lambda: sum(len(block) for block in JSONStream(summaries, gzip=True)))
+            self.stdout.write(f"{size:>9} summaries: json.dumps {mb(dumps_peak)} {ms(dumps_time)}, JSONStream {mb(stream_peak)} {ms(stream_time)}, "
+                              f"gzip {mb(gzip_peak)} {ms(gzip_time)} (traced)")
+
+    def benchmark_buckets(self, options):
+        """The month of every summary: numpy and pure Python month_buckets, against a datetime per summary."""
+        payloads = {
+            'epochs': lambda size: epochs(size),
+            'dailies': lambda size: [{'summaryId': str(i), 'calendarDate': utc_date(START_TIME + i * 3600), 'startTimeInSeconds': START_TIME + i * 3600}
+                                     for i in range(size)],
+            'user-metrics': lambda size: [{'summaryId': str(i), 'calendarDate': utc_date(START_TIME + i * 3600)} for i in range(size)],
+        }
+        for name, payload in payloads.items():
+            for size in self.sizes('buckets', options):
+                summaries = payload(size)
+                per_summary_time, expected = timed(lambda: [datetime.fromtimestamp(month_buckets.summary_epoch(summary), timezone.utc).strftime('%Y-%m')
+                                                            for summary in summaries])
+                python_time, python_months = timed(bucket_months, summaries, None)
+                numpy_time, numpy_months = timed(bucket_months, summaries, month_buckets.numpy)
+                assert python_months == expected and numpy_months == expected
+                numpy_result = ms(numpy_time) if month_buckets.numpy is not None else 'not installed'
+                self.stdout.write(f"{name} {size:>7}: datetime per summary {ms(per_summary_time)}, pure Python {ms(python_time)}, numpy {numpy_result}")
+
+
+    def benchmark_claim(self, options):
+        """Claiming the next group of a backlog in id order, against ordering failed groups last (a sort on every claim)."""
+        claimable_summaries = worker.claimable_summaries
+        orderings = [('failures, id', lambda: claimable_summaries().order_by('failures', 'id')), ('id', claimable_summaries)]
+        for size in self.sizes('claim', options):
+            results = []
+            for name, candidates in orderings:
+                with rolled_back(), override_settings(SUMMARIES_QUIET_SECONDS=0), mock.patch.object(worker, 'claimable_summaries', candidates):
+                    SummariesToProcess.objects.bulk_create(
+                        [SummariesToProcess(garmin_user_id=f'benchmark-{i}', file_name='epochs-2021-04', summaries_data=compress_json_string('[]'))
+                         for i in range(size)], batch_size=1000)
+                    duration, group = timed(worker.claim_next_summaries, 'benchmark')
+                    assert group is not None
+                results.append(f"order by {name} {ms(duration)}")
+            self.stdout.write(f"{size:>9} pending groups, one claim: {', '.join(results)}")
+
+    def benchmark_wakeup(self, options):
+        """
+        A handle_summaries thread: the time from posting a push notification to the start of its upload, and the queries
+        it makes while idle, when notified against polling every 0.5 s. The worker thread has its own database connection,
+        so nothing is rolled back, its rows are deleted afterwards.
+        """
+        uploads = queue.Queue()
+
+        def save_summaries(oh_user, summaries, file_name):
+            uploads.put(time.perf_counter())
+            return summaries
+
+        modes = [
+            ('polling every 0.5 s', lambda idle_sleep: WORKER_IDLE_MIN_SLEEP, lambda channel: None),
+            ('notified', next_idle_sleep, notify),
+        ]
+        for name, idle_sleep, notify_workers in modes:
+            idle_queries, latencies = [], []
+            with override_settings(WORKER_MODE='threads', WEBHOOK_INGEST_MODE='parse', SUMMARIES_QUIET_SECONDS=0), \
+                    mock.patch.object(worker, 'next_idle_sleep', idle_sleep), mock.patch.object(worker, 'notify', notify_workers), \
+                    mock.patch.object(worker, 'save_summaries', save_summaries), mock.patch.object(worker, 'get_oh_user_from_garmin_id'), \
+                    mock.patch.object(worker, 'update_retrieved_data_log'):
+                try:
+                    with worker_thread(idle_queries):
+                        time.sleep(options['idle_seconds'])
+                    with worker_thread([]):
+                        client = Client()
+                        for i in range(options['posts']):
+                            time.sleep(random.uniform(0.5, 1))  # Post when the worker is idle, at any point of its sleep
+                            posted_at = time.perf_counter()
+                            client.post('/garmin-endpoint/epochs/', data=json.dumps({'epochs': epochs(1, first_id=i)}), content_type='application/json')
+                            latencies.append(uploads.get(timeout=30) - posted_at)
+                finally:
+                    SummariesToProcess.objects.filter(garmin_user_id='benchmark').delete()
+            self.stdout.write(f"{name}: push notification to upload {ms(sum(latencies) / len(latencies))} on average, {ms(max(latencies))} max, "
+                              f"{idle_queries[0]} queries in {options['idle_seconds']:g} s idle")
+
+def epochs(count, first_id=0):
+    return [{'summaryId': f'x{i}', 'userId': 'benchmark', 'startTimeInSeconds': START_TIME + i * 60, 'durationInSeconds': 900, 'activityType': 'WALKING',
+             'steps': i % 100, 'distanceInMeters': (i % 100) * 0.7, 'activeKilocalories': 3, 'met': 1.5, 'intensity': 'ACTIVE'}
+            for i in range(first_id, first_id + count)]
+
+
+def epochs_for_bytes(size_bytes):
+    return epochs(size_bytes // len(json.dumps(epochs(1)[0])))
+
+
+def utc_date(epoch):
+    return datetime.fromtimestamp(epoch, timezone.utc).strftime('%Y-%m-%d')
+
+
+def bucket_months(summaries, numpy):
+    with mock.patch.object(month_buckets, 'numpy', numpy), mock.patch.object(month_buckets, 'NUMPY_MIN_SUMMARIES', 0):
+        return month_buckets.month_names(month_buckets.summary_epochs(summaries))
+
+
+def save_json_row(file_name, garmin_user_id, summaries):
+    """How save_summaries_for_delayed_processing saved the summaries before they were compressed."""
+    summaries_json = json.dumps(summaries)
+    SummariesToProcess.objects.create(summaries_json=summaries_json, garmin_user_id=garmin_user_id, file_name=file_name,
+                                      summaries_count=len(summaries), size_bytes=len(summaries_json))
+
+
+@contextmanager
+def rolled_back():
+    with transaction.atomic():
+        yield
+        transaction.set_rollback(True)
+
+
+@contextmanager
+def worker_thread(queries):
+    """Run worker.handle_summaries in a thread meanwhile, then append the number of queries it made to queries."""
+    def run():
+        try:
+            with CaptureQueriesContext(connection) as captured:
+                worker.handle_summaries()
+            queries.append(len(captured))
+        finally:
+            connection.close()
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    try:
+        yield
+    finally:
+        worker.process_terminated = True
+        notify_all_local()
+        thread.join()
+        worker.process_terminated = False
+
+
+class StubServer(ThreadingHTTPServer):
+    """Local keep-alive HTTP server that counts the connections it accepted."""
+    daemon_threads = True
+
+    def __init__(self):
+        self.connections = 0
+        super().__init__(('127.0.0.1', 0), StubHandler)
+
+    def process_request(self, request, client_address):
+        self.connections += 1
+        super().process_request(request, client_address)
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True  # Headers and body are written separately, which stalls keep-alive connections otherwise
+
+    def do_GET(self):
+        body = b'[]'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+
+def traced(function, *args):
+    """Like timed, with the peak of the memory allocated while it ran. Tracing slows it down."""
+    tracemalloc.start()
+    try:
+        start = time.perf_counter()
+        result = function(*args)
+        duration = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return duration, peak, result
+
+
+def ms(seconds):
+    return f"{seconds * 1000:.1f} ms"
+
+
+def mb(size_bytes):
+    return f"{size_bytes / 1024 / 1024:.1f} MB"
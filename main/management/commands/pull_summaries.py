@@ -0,0 +1,58 @@
+import io
+import json
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from main.async_garmin_health import pull_summaries
+from main.models import GarminMember
+from main.worker import handle_summaries_delayed
+
+# AsyncGarminHealth summary names -> (summaries name, data type, fields to remove) of the matching push notification
+PULLED_SUMMARIES = {
+    'dailies': ('dailies', 'dailies', ['activityType']),
+    'sleep': ('sleeps', 'sleep', None),
+    'body': ('bodyComps', 'body-composition', None),
+    'stress': ('stressDetails', 'stress', None),
+    'userMetrics': ('userMetrics', 'user-metrics', None),
+}
+
+
+class Command(BaseCommand):
+    help = 'Pull the summaries uploaded in a time range from the Garmin Health API for all authorized members (or the given ones), ' \
+           'and save them for processing like a push notification. Use it to catch up on push notifications that were missed.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=float, default=1, help='Length of the time range, ending at --end')
+        parser.add_argument('--end', type=int, help='End of the time range in seconds since the epoch, defaults to now')
+        parser.add_argument('--member', action='append', help='Open Humans id of a member to pull the summaries of, can be repeated')
+        parser.add_argument('--summaries', action='append', choices=sorted(PULLED_SUMMARIES.keys()), help='Summaries to pull, defaults to all')
+        parser.add_argument('--concurrency', type=int, default=10, help='Maximum number of requests in flight')
+
+    def handle(self, *args, **options):
+        end_time = options['end'] or int(time.time())
+        start_time = end_time - int(options['days'] * 86400)
+        members = GarminMember.objects.filter(userid__isnull=False, has_health_export_permission=True).select_related('member')
+        if options['member']:
+            members = members.filter(member__oh_id__in=options['member'])
+        members = list(members)
+        if len(members) == 0:
+            raise CommandError("No authorized members found")
+
+        names = options['summaries'] or list(PULLED_SUMMARIES.keys())
+        results = pull_summaries(settings.GARMIN_KEY, settings.GARMIN_SECRET, members, names, start_time, end_time,
+                                 max_concurrency=options['concurrency'])
+
+        pulled, failed = 0, 0
+        for garmin_member, name, summaries in results:
+            if isinstance(summaries, Exception):
+                failed += 1
+                self.stderr.write(f"Failed to pull {name} of member {garmin_member.member.oh_id}: {summaries}")
+                continue
+            summaries_name, data_type, fields_to_remove = PULLED_SUMMARIES[name]
+            body = json.dumps({summaries_name: [dict(summary, userId=garmin_member.userid) for summary in summaries]}).encode()
+            handle_summaries_delayed(io.BytesIO(body), summaries_name, data_type, fields_to_remove)
+            pulled += len(summaries)
+
+        self.stdout.write(f"Pulled {pulled} summaries for {len(members)} members, {failed} requests failed")
@@ -0,0 +1,87 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from threading import Event, Thread
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from main.consts import SUMMARIES_HEARTBEAT_SECONDS
+from main.helpers import data_file_name, exchange_oauth2_member, file_format, reencode_file
+from main.models import GarminMember
+from main.worker import get_worker_id, get_worker_process_id, hold_summaries, release_held_summaries, renew_leases
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Upload the summary files on Open Humans again in another SUMMARIES_FILE_FORMAT, several files at the same time. ' \
+           'The worker holds off on the summaries of a file while it is re-encoded. Files the worker is processing are skipped, ' \
+           'run it again to pick them up.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=['json', 'gzip'], default='gzip', help='Format to re-encode the files in')
+        parser.add_argument('--threads', type=int, default=4, help='Number of files re-encoded at the same time')
+        parser.add_argument('--member', help='Garmin user id of the only member to re-encode')
+
+    def handle(self, *args, **options):
+        garmin_members = GarminMember.objects.filter(userid__isnull=False).select_related('member')
+        if options['member']:
+            garmin_members = garmin_members.filter(userid=options['member'])
+            if not garmin_members.exists():
+                raise CommandError(f"No member with Garmin user id {options['member']}")
+
+        reencoded, failed, skipped = 0, 0, 0
+        with renewing_held_leases(), ThreadPoolExecutor(options['threads'], thread_name_prefix='reencode') as executor:
+            futures = {}
+            for garmin_member in garmin_members.iterator():
+                oh_user = garmin_member.member
+                access_token = oh_user.get_access_token()
+                for file in exchange_oauth2_member(access_token)['data']:
+                    if data_file_name(file) is not None and file_format(file) != options['format']:
+                        futures[executor.submit(reencode_held_file, garmin_member, access_token, file, options['format'])] = file
+
+            for future in as_completed(futures):
+                file = futures[future]
+                try:
+                    if future.result():
+                        reencoded += 1
+                    else:
+                        _LOGGER.info(f"Skipping {file['basename']} ({file['id']}), the worker is processing it")
+                        skipped += 1
+                except Exception:
+                    _LOGGER.exception(f"Failed to re-encode {file['basename']} ({file['id']})")
+                    failed += 1
+
+        self.stdout.write(f"Re-encoded {reencoded} files as {options['format']}, {failed} failed, skipped {skipped}")
+
+
+def reencode_held_file(garmin_member, access_token, file, file_format):
+    """Re-encode the file while holding its summaries, so the worker can't replace it at the same time. False if it's busy."""
+    file_name, worker_id = data_file_name(file), get_worker_id()
+    if not hold_summaries(file_name, garmin_member.userid, worker_id):
+        return False
+    try:
+        reencode_file(garmin_member.member, access_token, file, file_format)
+        return True
+    finally:
+        release_held_summaries(file_name, garmin_member.userid, worker_id)
+
+
+@contextmanager
+def renewing_held_leases():
+    """Renew the leases of the held summaries meanwhile, or release_expired_leases hands them back to the workers."""
+    done = Event()
+
+    def renew():
+        while not done.wait(SUMMARIES_HEARTBEAT_SECONDS):
+            renew_leases(get_worker_process_id())
+        connection.close()
+
+    heartbeat = Thread(target=renew, daemon=True)
+    heartbeat.start()
+    try:
+        yield
+    finally:
+        done.set()
+        heartbeat.join()
@@ -0,0 +1,73 @@
+import logging
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.test import Client, override_settings
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = 'Replay recorded Garmin push notifications against the webhook views and report their response times. ' \
+           'Payloads are read from PAYLOAD_DIR/<endpoint>/*.json, e.g. PAYLOAD_DIR/epochs/1.json is posted to /garmin-endpoint/epochs/. ' \
+           'Everything is rolled back afterwards.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('payload_dir')
+        parser.add_argument('--repeat', type=int, default=1, help='Number of times to replay every payload')
+        parser.add_argument('--ingest-mode', choices=['parse', 'raw'], help='Override WEBHOOK_INGEST_MODE')
+
+    def handle(self, *args, **options):
+        payloads = self.read_payloads(options['payload_dir'])
+        if len(payloads) == 0:
+            raise CommandError(f"No payloads found in {options['payload_dir']}")
+
+        overrides = {'WORKER_MODE': 'threads'}  # Don't queue Celery tasks for the replayed payloads
+        if options['ingest_mode']:
+            overrides['WEBHOOK_INGEST_MODE'] = options['ingest_mode']
+
+        logging.disable(logging.INFO)
+        durations = []
+        try:
+            with override_settings(**overrides), transaction.atomic():
+                client = Client()
+                for _ in range(options['repeat']):
+                    for endpoint, body in payloads:
+                        start = time.perf_counter()
+                        response = client.post(f'/garmin-endpoint/{endpoint}/', data=body, content_type='application/json')
+                        durations.append(time.perf_counter() - start)
+                        if response.status_code != 200:
+                            raise CommandError(f"Got status {response.status_code} for {endpoint}")
+                raise Rollback()
+        except Rollback:
+            pass
+        finally:
+            logging.disable(logging.NOTSET)
+
+        durations.sort()
+        self.stdout.write(f"Replayed {len(durations)} requests with {sum(len(body) for _, body in payloads) * options['repeat']} bytes")
+        self.stdout.write(f"p50: {percentile(durations, 50) * 1000:.1f} ms, p99: {percentile(durations, 99) * 1000:.1f} ms, max: {durations[-1] * 1000:.1f} ms")
+
+    @staticmethod
+    def read_payloads(payload_dir):
+        payloads = []
+        for endpoint in sorted(os.listdir(payload_dir)):
+            endpoint_dir = os.path.join(payload_dir, endpoint)
+            if not os.path.isdir(endpoint_dir):
+                continue
+            for file_name in sorted(os.listdir(endpoint_dir)):
+                if file_name.endswith('.json'):
+                    with open(os.path.join(endpoint_dir, file_name), 'rb') as payload_file:
+                        payloads.append((endpoint, payload_file.read()))
+        return payloads
+
+
+def percentile(sorted_values, percent):
+    index = min(len(sorted_values) - 1, int(round(percent / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
@@ -1,6 +1,7 @@
 import logging
 
-from django.core.management.base import BaseCommand
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -8,12 +9,19 @@ _LOGGER = logging.getLogger(__name__)
 class Command(BaseCommand):
     help = 'Run threads that will process the async tasks'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=1, help='Number of worker processes to fork, each running its own threads')
+        parser.add_argument('--skip-backfill', action='store_true', help="Don't run the backfill thread, e.g. for additional worker dynos")
+
     def handle(self, *args, **options):
         from dotenv import load_dotenv
 
         load_dotenv()
 
-        from main.worker import start_worker_threads
+        if settings.WORKER_MODE == 'celery':
+            raise CommandError("WORKER_MODE is 'celery', start the Celery workers instead (see Procfile)")
+
+        from main.worker import start_worker_processes
 
-        _LOGGER.info("Starting worker threads")
-        start_worker_threads()
+        _LOGGER.info(f"Starting {options['processes']} worker process(es)")
+        start_worker_processes(options['processes'], with_backfill=not options['skip_backfill'])
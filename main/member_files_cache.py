@@ -0,0 +1,58 @@
+import time
+from threading import Lock
+
+
+class MemberFilesCache(object):
+    """
+    In memory cache of the Open Humans file listings of members (the result of exchange_oauth2_member), so processing a
+    burst of files for the same member takes one listing instead of one per file.
+
+    Listings are cached with the GarminMember.files_version they belong to. Every worker process increases the version
+    of a member when it changes the files of the member, so a cached listing is only used as long as no other process
+    changed the files since. Our own uploads and deletes update the cached listing in place. Files we uploaded have no
+    download_url in it, a new listing is needed to download them. Changes made outside of the worker (e.g. by the
+    member) show up after ttl_seconds at the latest.
+    """
+
+    def __init__(self, ttl_seconds):
+        self._ttl_seconds = ttl_seconds
+        self._lock = Lock()
+        self._listings = {}  # oh_id -> (expires at, files_version, listing)
+
+    def get(self, oh_id, version, fetch):
+        """Return the cached listing of the member if it's of files_version version and didn't expire, or fetch() it."""
+        with self._lock:
+            expires_at, cached_version, listing = self._listings.get(oh_id, (0, None, None))
+        if listing is not None and cached_version == version and expires_at > time.monotonic():
+            return listing
+        return self.refresh(oh_id, version, fetch)
+
+    def refresh(self, oh_id, version, fetch):
+        """Fetch the listing of the member, which has at least files_version version."""
+        listing = fetch()
+        if self._ttl_seconds > 0:
+            with self._lock:
+                # Don't replace a listing another thread updated to a newer version in the meantime
+                if self._listings.get(oh_id, (0, -1, None))[1] <= version:
+                    self._listings[oh_id] = (time.monotonic() + self._ttl_seconds, version, listing)
+        return listing
+
+    def update(self, oh_id, version, added=(), removed_ids=()):
+        """
+        Apply a change this process made to the files of the member, after which the files have version version.
+        If another process changed the files too, the cached listing is dropped instead.
+        """
+        with self._lock:
+            if oh_id not in self._listings:
+                return
+            expires_at, cached_version, listing = self._listings[oh_id]
+            if cached_version != version - 1:
+                del self._listings[oh_id]
+                return
+            files = [file for file in listing['data'] if file['id'] not in removed_ids] + list(added)
+            # A new listing instead of changing it, callers may still be iterating over the old one
+            self._listings[oh_id] = (expires_at, version, {**listing, 'data': files})
+
+    def invalidate(self, oh_id):
+        with self._lock:
+            self._listings.pop(oh_id, None)
@@ -0,0 +1,28 @@
+import logging
+from collections import defaultdict
+from threading import Lock
+
+_LOGGER = logging.getLogger(__name__)
+
+_lock = Lock()
+_counters = defaultdict(int)
+_logged_counters = {}
+
+
+def increment(name, value=1):
+    with _lock:
+        _counters[name] += value
+
+
+def get_counters():
+    """Counters of this process since it started."""
+    with _lock:
+        return dict(_counters)
+
+
+def log_counters():
+    global _logged_counters
+    counters = get_counters()
+    if counters != _logged_counters:
+        _LOGGER.info(f"Worker counters: {', '.join(f'{name}={value}' for name, value in sorted(counters.items()))}")
+        _logged_counters = counters
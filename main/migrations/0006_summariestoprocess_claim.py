@@ -0,0 +1,36 @@
+# Generated by Django 3.2.25 on 2026-10-18 09:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0005_auto_20210420_1925'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='summariestoprocess',
+            name='claimed_at',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AddField(
+            model_name='summariestoprocess',
+            name='claimed_by',
+            field=models.CharField(max_length=255, null=True),
+        ),
+        migrations.AddField(
+            model_name='summariestoprocess',
+            name='status',
+            field=models.CharField(default='pending', max_length=16),
+        ),
+        migrations.AddIndex(
+            model_name='summariestoprocess',
+            index=models.Index(fields=['garmin_user_id', 'file_name'], name='main_summar_garmin__5b01c3_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='summariestoprocess',
+            index=models.Index(fields=['status', 'id'], name='main_summar_status_145716_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-18 09:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0006_summariestoprocess_claim'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='summariestoprocess',
+            name='lease_expires_at',
+            field=models.DateTimeField(null=True),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 3.2.25 on 2026-10-18 09:11
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0007_summariestoprocess_lease'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='summariestoprocess',
+            name='received_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name='summariestoprocess',
+            name='size_bytes',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='summariestoprocess',
+            name='summaries_count',
+            field=models.IntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 3.2.25 on 2026-10-18 09:23
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0008_summariestoprocess_coalescing'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RawSummariesToProcess',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False)),
+                ('body', models.BinaryField()),
+                ('summaries_name', models.CharField(max_length=255)),
+                ('data_type', models.CharField(max_length=255)),
+                ('fields_to_remove', models.TextField(null=True)),
+                ('received_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('status', models.CharField(default='pending', max_length=16)),
+                ('claimed_by', models.CharField(max_length=255, null=True)),
+                ('lease_expires_at', models.DateTimeField(null=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='rawsummariestoprocess',
+            index=models.Index(fields=['status', 'id'], name='main_rawsum_status_0edf0f_idx'),
+        ),
+    ]
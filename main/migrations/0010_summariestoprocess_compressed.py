@@ -0,0 +1,35 @@
+# Generated by Django 3.2.25 on 2026-10-18 09:27
+import zlib
+
+from django.db import migrations, models
+
+
+def compress_summaries(apps, schema_editor):
+    # Same format as main.compression.compress_json, repeated here so this migration doesn't depend on the current code
+    SummariesToProcess = apps.get_model('main', 'SummariesToProcess')
+    for summaries_to_process in SummariesToProcess.objects.filter(summaries_data__isnull=True).only('id', 'summaries_json').iterator(chunk_size=100):
+        SummariesToProcess.objects.filter(id=summaries_to_process.id).update(
+            summaries_data=b'z' + zlib.compress(summaries_to_process.summaries_json.encode('utf-8'), 6),
+            summaries_json=None,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0009_rawsummariestoprocess'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='summariestoprocess',
+            name='summaries_data',
+            field=models.BinaryField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='summariestoprocess',
+            name='summaries_json',
+            field=models.TextField(null=True),
+        ),
+        migrations.RunPython(compress_summaries, migrations.RunPython.noop),
+    ]
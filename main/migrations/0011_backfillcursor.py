@@ -0,0 +1,28 @@
+# Generated by Django 3.2.25 on 2026-10-18 14:02
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0010_summariestoprocess_compressed'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BackfillCursor',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False)),
+                ('url', models.CharField(max_length=255)),
+                ('backfilled_from', models.DateTimeField()),
+                ('failures', models.IntegerField(default=0)),
+                ('retry_after', models.DateTimeField(null=True)),
+                ('garmin_member', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='backfill_cursors', to='main.garminmember')),
+            ],
+            options={
+                'unique_together': {('garmin_member', 'url')},
+            },
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 3.2.25 on 2026-10-18 15:10
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+def set_started_from(apps, schema_editor):
+    BackfillCursor = apps.get_model('main', 'BackfillCursor')
+    BackfillCursor.objects.update(started_from=F('backfilled_from'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0011_backfillcursor'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='backfillcursor',
+            name='last_called_at',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AddField(
+            model_name='backfillcursor',
+            name='started_from',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.RunPython(set_started_from, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='backfillcursor',
+            name='started_from',
+            field=models.DateTimeField(),
+        ),
+    ]
@@ -0,0 +1,31 @@
+from django.db import migrations
+from django.db.models import Count, Max, Min
+
+
+def merge_duplicates(apps, schema_editor):
+    RetrievedData = apps.get_model('main', 'RetrievedData')
+    duplicates = RetrievedData.objects.values('member', 'data_type') \
+        .annotate(count=Count('id'), min_id=Min('id'), min_date=Min('min_date'), max_date=Max('max_date')).filter(count__gt=1)
+    for duplicate in duplicates:
+        rows = RetrievedData.objects.filter(member=duplicate['member'], data_type=duplicate['data_type'])
+        rows.filter(id=duplicate['min_id']).update(min_date=duplicate['min_date'], max_date=duplicate['max_date'])
+        rows.exclude(id=duplicate['min_id']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0012_backfillcursor_adaptive'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicates, migrations.RunPython.noop),
+        migrations.RemoveIndex(
+            model_name='retrieveddata',
+            name='main_retrie_member__6b7f84_idx',
+        ),
+        migrations.AlterUniqueTogether(
+            name='retrieveddata',
+            unique_together={('member', 'data_type')},
+        ),
+    ]
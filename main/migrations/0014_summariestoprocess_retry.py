@@ -0,0 +1,21 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0013_retrieveddata_unique'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='summariestoprocess',
+            name='failures',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='summariestoprocess',
+            name='retry_after',
+            field=models.DateTimeField(null=True),
+        ),
+    ]
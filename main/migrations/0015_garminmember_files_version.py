@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0014_summariestoprocess_retry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='garminmember',
+            name='files_version',
+            field=models.IntegerField(default=0),
+        ),
+    ]
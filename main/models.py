@@ -1,4 +1,5 @@
 from django.db import models
+from django.utils import timezone
 
 from openhumans.models import OpenHumansMember
 
@@ -16,13 +17,56 @@ class GarminMember(models.Model):
     last_updated = models.DateTimeField(null=True)
     has_health_export_permission = models.BooleanField(default=False)
     was_backfilled = models.BooleanField(default=False)
+    files_version = models.IntegerField(default=0)  # increased whenever the worker changes the files of the member on Open Humans
+
+
+class BackfillCursor(models.Model):
+    """
+    Backfill progress of a Garmin member for one of the GARMIN_BACKFILL_URLS.
+    Windows of BACKFILL_SECONDS are requested backwards in time starting at backfilled_from.
+    """
+    id = models.AutoField(primary_key=True)
+    garmin_member = models.ForeignKey(GarminMember, related_name="backfill_cursors", on_delete=models.CASCADE)
+    url = models.CharField(max_length=255)
+    started_from = models.DateTimeField()  # end of the first window
+    backfilled_from = models.DateTimeField()  # start of the oldest window that Garmin accepted
+    last_called_at = models.DateTimeField(null=True)
+    failures = models.IntegerField(default=0)  # consecutive failed calls for the next window
+    retry_after = models.DateTimeField(null=True)
+
+    class Meta:
+        unique_together = [('garmin_member', 'url')]
 
 
 class SummariesToProcess(models.Model):
+    """
+    Summaries received from Garmin that still need to be merged into the Open Humans files.
+    Rows for the same (garmin_user_id, file_name) are claimed and processed together by a single worker.
+    """
+    PENDING = 'pending'
+    CLAIMED = 'claimed'
+
     id = models.AutoField(primary_key=True)
-    summaries_json = models.TextField()
+    summaries_json = models.TextField(null=True)  # Only for rows saved before summaries_data existed
+    summaries_data = models.BinaryField(null=True)  # See compression.compress_json
     garmin_user_id = models.CharField(max_length=255, null=False)
     file_name = models.CharField(max_length=255, null=False)
+    received_at = models.DateTimeField(default=timezone.now)
+    summaries_count = models.IntegerField(default=0)
+    size_bytes = models.IntegerField(default=0)  # size of the summaries as JSON
+    status = models.CharField(max_length=16, default=PENDING)
+    claimed_by = models.CharField(max_length=255, null=True)  # id of the worker thread processing this row
+    claimed_at = models.DateTimeField(null=True)
+    lease_expires_at = models.DateTimeField(null=True)  # renewed by the heartbeat of the claiming worker process
+    failures = models.IntegerField(default=0)  # times processing the group of this row failed in a row
+    retry_after = models.DateTimeField(null=True)  # a failed group isn't claimed again before this
+    push_id = models.CharField(max_length=32, null=True)  # the push notification of the summaries, split over several rows if it was big
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['garmin_user_id', 'file_name']),
+            models.Index(fields=['status', 'id']),
+        ]
 
 
 class RetrievedData(models.Model):
@@ -32,7 +76,30 @@ class RetrievedData(models.Model):
     min_date = models.DateTimeField(null=False)
     max_date = models.DateTimeField(null=False)
 
+    class Meta:
+        unique_together = [('member', 'data_type')]
+
+
+class RawSummariesToProcess(models.Model):
+    """
+    Compressed body of a Garmin push notification, saved as is to answer Garmin quickly.
+    The worker parses it into SummariesToProcess rows later.
+    """
+    PENDING = 'pending'
+    CLAIMED = 'claimed'
+    FAILED = 'failed'
+
+    id = models.AutoField(primary_key=True)
+    body = models.BinaryField()  # zlib compressed
+    summaries_name = models.CharField(max_length=255, null=False)
+    data_type = models.CharField(max_length=255, null=False)
+    fields_to_remove = models.TextField(null=True)  # JSON list
+    received_at = models.DateTimeField(default=timezone.now)
+    status = models.CharField(max_length=16, default=PENDING)
+    claimed_by = models.CharField(max_length=255, null=True)
+    lease_expires_at = models.DateTimeField(null=True)
+
     class Meta:
         indexes = [
-            models.Index(fields=['member', 'data_type']),
+            models.Index(fields=['status', 'id']),
         ]
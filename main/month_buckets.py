@@ -0,0 +1,80 @@
+import bisect
+import calendar
+import functools
+from datetime import datetime, timezone
+
+try:
+    import numpy
+except ImportError:  # numpy is optional, the pure Python lookup is used without it
+    numpy = None
+
+NUMPY_MIN_SUMMARIES = 2000  # Below this, converting to and from numpy arrays costs more than it saves
+
+
+def summary_epoch(summary):
+    """The timestamp of the summary in seconds since the epoch. A calendarDate is midnight UTC of that date."""
+    if "startTimeInSeconds" in summary:
+        # Used in almost all types of summaries
+        return summary["startTimeInSeconds"]
+    if "measurementTimeInSeconds" in summary:
+        # Used for body composition
+        return summary["measurementTimeInSeconds"]
+    if "calendarDate" in summary:
+        # Used for user metrics
+        return calendar_date_epoch(summary["calendarDate"])
+
+    raise Exception(f"Failed to find timestamp field in summary. Found keys {summary.keys()}")
+
+
+@functools.lru_cache(maxsize=4096)  # A push holds the same few dates many times
+def calendar_date_epoch(calendar_date):
+    return calendar.timegm((int(calendar_date[0:4]), int(calendar_date[5:7]), int(calendar_date[8:10]), 0, 0, 0))
+
+
+def summary_epochs(summaries):
+    """The summary_epoch of all summaries, in one pass."""
+    epochs = []
+    append = epochs.append
+    for summary in summaries:
+        epoch = summary.get("startTimeInSeconds")
+        append(epoch if epoch is not None else summary_epoch(summary))
+    return epochs
+
+
+def month_table(min_epoch, max_epoch):
+    """The starts of the UTC months from the month of min_epoch up to max_epoch, and their 'YYYY-MM' names."""
+    first = datetime.fromtimestamp(min_epoch, timezone.utc)
+    year, month = first.year, first.month
+    starts, names = [], []
+    while True:
+        start = calendar.timegm((year, month, 1, 0, 0, 0))
+        if start > max_epoch:
+            return starts, names
+        starts.append(start)
+        names.append(f"{year:04d}-{month:02d}")
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+
+
+def month_indexes(epochs, starts):
+    """The index in starts of the month of every epoch."""
+    if numpy is not None and len(epochs) >= NUMPY_MIN_SUMMARIES:
+        return (numpy.searchsorted(numpy.asarray(starts), numpy.asarray(epochs), side='right') - 1).tolist()
+
+    # Summaries mostly come in time order, so the month of the previous one usually matches
+    indexes = []
+    append = indexes.append
+    index, low, high = 0, starts[0], starts[1] if len(starts) > 1 else float('inf')
+    for epoch in epochs:
+        if not low <= epoch < high:
+            index = bisect.bisect_right(starts, epoch) - 1
+            low, high = starts[index], starts[index + 1] if index + 1 < len(starts) else float('inf')
+        append(index)
+    return indexes
+
+
+def month_names(epochs):
+    """The 'YYYY-MM' name of the UTC month of every epoch."""
+    if len(epochs) == 0:
+        return []
+    starts, names = month_table(min(epochs), max(epochs))
+    return [names[index] for index in month_indexes(epochs, starts)]
@@ -0,0 +1,39 @@
+import time
+from threading import Lock
+
+
+class TokenBucket(object):
+    """Thread-safe token bucket: allows `rate` acquisitions per second on average, with bursts of up to `capacity`."""
+
+    def __init__(self, rate, capacity=1):
+        self._rate = rate
+        self._capacity = capacity
+        self._tokens = capacity
+        self._updated_at = time.monotonic()
+        self._lock = Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self._capacity, self._tokens + (now - self._updated_at) * self._rate)
+        self._updated_at = now
+
+    def try_acquire(self):
+        with self._lock:
+            self._refill()
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return True
+            return False
+
+    def time_until_available(self):
+        with self._lock:
+            self._refill()
+            return max(0.0, (1 - self._tokens) / self._rate)
+
+    def acquire(self, is_terminated=lambda: False):
+        """Block until a token is available. Returns False instead if is_terminated() is or becomes True."""
+        while not is_terminated():
+            if self.try_acquire():
+                return True
+            time.sleep(min(self.time_until_available(), 0.5))
+        return False
@@ -0,0 +1,101 @@
+import random
+import time
+from email.utils import parsedate_to_datetime
+
+from django.utils import timezone
+from requests.exceptions import ConnectionError, Timeout
+
+from . import metrics
+
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+RETRYABLE_EXCEPTIONS = (ConnectionError, Timeout)
+
+
+def retry_after_seconds(response):
+    """Seconds to wait according to the Retry-After header of the response, None if it has none."""
+    if response is None:
+        return None
+    value = response.headers.get('Retry-After')
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - timezone.now()).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryPolicy(object):
+    """
+    When and how often failed HTTP calls are retried. The delay doubles from base_delay up to max_delay, with jitter so clients
+    that failed together don't retry together. A Retry-After header of the server replaces the delay. No retry starts
+    that would end after the deadline. Retries and time spent waiting are counted in the metrics as <name>_retries and
+    <name>_retry_wait_seconds.
+    """
+
+    def __init__(self, name, max_attempts=4, base_delay=1, max_delay=60, deadline=300, retryable_status_codes=RETRYABLE_STATUS_CODES):
+        self.name = name
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.retryable_status_codes = retryable_status_codes
+
+    def is_retryable(self, response=None, exception=None):
+        if exception is not None:
+            return isinstance(exception, RETRYABLE_EXCEPTIONS)
+        return self.is_retryable_status(response.status_code)
+
+    def is_retryable_status(self, status_code):
+        return status_code in self.retryable_status_codes
+
+    def delay(self, attempt, response=None):
+        """Seconds to wait before the next attempt, after `attempt` attempts failed."""
+        retry_after = retry_after_seconds(response)
+        if retry_after is not None:
+            return retry_after
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def call(self, request, is_terminated=lambda: False):
+        """
+        Call request() until it returns a response that isn't retryable, or no retry is left.
+        Returns the last response, or raises the exception of the last attempt if it didn't get a response.
+        """
+        deadline = time.monotonic() + self.deadline
+        attempt = 0
+        while True:
+            attempt += 1
+            response, exception = None, None
+            try:
+                response = request()
+            except RETRYABLE_EXCEPTIONS as e:
+                exception = e
+
+            if attempt >= self.max_attempts or not self.is_retryable(response, exception):
+                break
+            delay = self.delay(attempt, response)
+            if time.monotonic() + delay > deadline or not self._sleep(delay, is_terminated):
+                break
+            self.count_retry(delay)
+
+        if exception is not None:
+            raise exception
+        return response
+
+    def count_retry(self, delay):
+        metrics.increment(f'{self.name}_retries')
+        metrics.increment(f'{self.name}_retry_wait_seconds', round(delay, 3))
+
+    @staticmethod
+    def _sleep(seconds, is_terminated):
+        end = time.monotonic() + seconds
+        while not is_terminated():
+            remaining = end - time.monotonic()
+            if remaining <= 0:
+                return True
+            time.sleep(min(remaining, 0.5))
+        return False
@@ -0,0 +1,136 @@
+import logging
+import os
+import pickle
+import tempfile
+from threading import Lock
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class SummariesCache(object):
+    """
+    Size bounded LRU cache on local disk for the summaries of the monthly files we uploaded to Open Humans.
+
+    Entries are keyed by Open Humans member, file name and the id of the remote file, so an entry is only used
+    as long as the file on Open Humans is still the one we uploaded. The cache only holds data we wrote
+    ourselves, so it is stored with pickle, which loads a lot faster than JSON.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self._directory = directory
+        self._max_bytes = max_bytes
+        self._lock = Lock()
+        self._size = None  # Estimated size of the cache in bytes, computed on first use
+
+    @property
+    def enabled(self):
+        return self._max_bytes > 0
+
+    def _member_dir(self, oh_id):
+        return os.path.join(self._directory, str(oh_id))
+
+    def _path(self, oh_id, file_name, file_id):
+        return os.path.join(self._member_dir(oh_id), f"{file_name}.{file_id}.pickle")
+
+    def _index_path(self, oh_id, file_name, file_id):
+        return os.path.join(self._member_dir(oh_id), f"{file_name}.{file_id}.index.pickle")
+
+    def get(self, oh_id, file_name, file_id):
+        """Return the cached summaries of the remote file with file_id, or None."""
+        return self._load(self._path(oh_id, file_name, file_id))
+
+    def get_index(self, oh_id, file_name, file_id):
+        """Return the cached summaryId -> digest index of the remote file with file_id, or None."""
+        return self._load(self._index_path(oh_id, file_name, file_id))
+
+    def _load(self, path):
+        if not self.enabled:
+            return None
+        try:
+            with open(path, 'rb') as cache_file:
+                data = pickle.load(cache_file)
+            os.utime(path)  # Mark as recently used
+            return data
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            _LOGGER.warning(f"Ignoring unreadable cache entry {path}: {e}")
+            self._remove(path)
+            return None
+
+    def put(self, oh_id, file_name, file_id, summaries, index):
+        """
+        Store the summaries of the remote file with file_id and their summaryId -> digest index, replacing older versions of
+        the same file. The index is stored separately, so it can be checked without loading the summaries.
+        """
+        if not self.enabled:
+            return
+        self.invalidate(oh_id, file_name)
+        member_dir = self._member_dir(oh_id)
+        os.makedirs(member_dir, exist_ok=True)
+        self._write(member_dir, self._index_path(oh_id, file_name, file_id), index)
+        self._write(member_dir, self._path(oh_id, file_name, file_id), summaries)
+        self._evict_if_needed()
+
+    def _write(self, member_dir, path, data):
+        # Write to a temporary file first, so other processes never read a partially written entry
+        fd, tmp_path = tempfile.mkstemp(dir=member_dir, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as cache_file:
+            pickle.dump(data, cache_file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            if self._size is not None:
+                self._size += os.path.getsize(path)
+
+    def invalidate(self, oh_id, file_name):
+        member_dir = self._member_dir(oh_id)
+        if not os.path.isdir(member_dir):
+            return
+        for entry in os.scandir(member_dir):
+            if entry.name.startswith(f"{file_name}.") and entry.name.endswith('.pickle'):
+                self._remove(entry.path)
+
+    def _remove(self, path):
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except FileNotFoundError:
+            return
+        with self._lock:
+            if self._size is not None:
+                self._size -= size
+
+    def _entries(self):
+        entries = []
+        if not os.path.isdir(self._directory):
+            return entries
+        for member_dir in os.scandir(self._directory):
+            if member_dir.is_dir():
+                for entry in os.scandir(member_dir.path):
+                    if entry.name.endswith('.pickle'):
+                        entries.append(entry)
+        return entries
+
+    def _evict_if_needed(self):
+        with self._lock:
+            if self._size is not None and self._size <= self._max_bytes:
+                return
+            # Other worker processes share the directory, so the size is recomputed from disk before evicting
+            entries = []
+            for entry in self._entries():
+                try:
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+                except FileNotFoundError:
+                    pass
+            size = sum(entry_size for _, entry_size, _ in entries)
+            for _, entry_size, path in sorted(entries):
+                if size <= self._max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                    size -= entry_size
+                except FileNotFoundError:
+                    pass
+            self._size = size
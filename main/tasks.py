@@ -0,0 +1,78 @@
+import logging
+from threading import Thread
+
+from celery import shared_task
+from celery.signals import worker_process_init
+from django.conf import settings
+from django.core.exceptions import ObjectDoesNotExist
+
+from .backfill import handle_backfill_for_member
+from .consts import BACKFILL_RETRY_COUNTDOWN
+from . import metrics
+from .models import GarminMember, SummariesToProcess, RawSummariesToProcess
+from .worker import get_worker_id, claim_summaries, process_summaries_for_user_and_file, has_pending_summaries, is_summaries_claimed, schedule_summaries, handle_heartbeats, \
+    claim_raw_summaries, process_raw_summaries as process_raw_summaries_for_id, summaries_retry_countdown
+
+_LOGGER = logging.getLogger(__name__)
+
+
+@worker_process_init.connect
+def start_heartbeats(**kwargs):
+    # Keeps the leases on the summaries claimed by the tasks of this Celery worker process alive
+    Thread(target=handle_heartbeats, daemon=True).start()
+
+
+@shared_task(bind=True, ignore_result=True)
+def process_summaries(self, file_name, garmin_user_id):
+    """
+    Process all pending summaries for garmin_user_id and file_name.
+    Only one task at a time can claim a (garmin_user_id, file_name) group, duplicate tasks return immediately.
+    The task holding the claim schedules a new task for summaries that arrived while it was processing.
+    """
+    worker_id = get_worker_id()
+    # Eager tasks (e.g. in tests) can't wait for more summaries to arrive
+    if not claim_summaries(file_name, garmin_user_id, worker_id, coalesce=not self.request.is_eager):
+        if has_pending_summaries(file_name, garmin_user_id) and not is_summaries_claimed(file_name, garmin_user_id):
+            # Still coalescing or waiting to retry, check again later
+            countdown = max(settings.SUMMARIES_QUIET_SECONDS, summaries_retry_countdown(file_name, garmin_user_id))
+            schedule_summaries(file_name, garmin_user_id, countdown=countdown)
+        return
+
+    if not process_summaries_for_user_and_file(file_name, garmin_user_id, worker_id):
+        if not self.request.is_eager:
+            schedule_summaries(file_name, garmin_user_id, countdown=summaries_retry_countdown(file_name, garmin_user_id))
+    elif has_pending_summaries(file_name, garmin_user_id):
+        schedule_summaries(file_name, garmin_user_id)
+
+
+@shared_task(ignore_result=True)
+def process_raw_summaries(raw_summaries_id):
+    worker_id = get_worker_id()
+    if claim_raw_summaries(raw_summaries_id, worker_id):
+        process_raw_summaries_for_id(raw_summaries_id, worker_id)
+
+
+@shared_task(ignore_result=True)
+def schedule_pending_summaries():
+    """Periodic safety net for pending summaries whose task got lost, e.g. because their lease expired."""
+    for raw_summaries_id in RawSummariesToProcess.objects.filter(status=RawSummariesToProcess.PENDING).values_list('id', flat=True):
+        process_raw_summaries.delay(raw_summaries_id)
+    groups = SummariesToProcess.objects.filter(status=SummariesToProcess.PENDING).values_list('file_name', 'garmin_user_id').distinct()
+    for file_name, garmin_user_id in groups:
+        schedule_summaries(file_name, garmin_user_id)
+    metrics.log_counters()
+
+
+@shared_task(bind=True, ignore_result=True, rate_limit=settings.CELERY_BACKFILL_RATE_LIMIT, max_retries=None)
+def backfill_member(self, garmin_member_id):
+    try:
+        garmin_member = GarminMember.objects.get(id=garmin_member_id, was_backfilled=False, userid__isnull=False, has_health_export_permission=True)
+    except ObjectDoesNotExist:
+        return  # Already backfilled or not authorized (anymore)
+
+    handle_backfill_for_member(garmin_member)
+
+    garmin_member.refresh_from_db()
+    if not garmin_member.was_backfilled and garmin_member.has_health_export_permission:
+        _LOGGER.info(f"Backfill for garmin member {garmin_member_id} didn't finish, retrying later")
+        raise self.retry(countdown=BACKFILL_RETRY_COUNTDOWN)
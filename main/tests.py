@@ -1,3 +1,563 @@
-from django.test import TestCase
+import asyncio
+import io
+import json
+import re
+import shutil
+import socket
+import tempfile
+import time
+from collections import Counter
+from concurrent.futures import Executor, Future
+from datetime import timedelta
+from threading import Thread
+from types import SimpleNamespace
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from aiohttp import web
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from openhumans.models import OpenHumansMember
+
+from oh_template.celery import app as celery_app
+from main import async_garmin_health, helpers, metrics, tasks, worker
+from main.async_garmin_health import AsyncGarminHealth, pull_summaries
+from main.compression import compress_json_string, decompressed_blocks
+from main.consts import SUMMARIES_RETRY_COUNTDOWN
+from main.garmin_health import GarminHealth, GarminHealthFatalException
+from main.http_pool import oauth1_session
+from main.management.commands import benchmark
+from main.member_files_cache import MemberFilesCache
+from main.models import GarminMember, SummariesToProcess
+from main.retry import RetryPolicy
+
+
+def create_member(oh_id, garmin_user_id, **fields):
+    user = User.objects.create(username=f'user-{oh_id}')
+    oh_member = OpenHumansMember.objects.create(oh_id=oh_id, user=user, access_token='access', refresh_token='refresh',
+                                                token_expires=timezone.now() + timedelta(days=1))
+    fields = {'access_token': 'token', 'access_token_secret': 'secret', **fields}
+    return GarminMember.objects.create(member=oh_member, userid=garmin_user_id, **fields)
+
+
+def summary(summary_id, start_time=1618000000):
+    return {'summaryId': summary_id, 'startTimeInSeconds': start_time}
+
+
+class FakeOpenHumans(object):
+    """Files of Open Humans members in memory, patched in for the functions of helpers that call Open Humans."""
+
+    def __init__(self):
+        self.files = {}  # id -> (record, content)
+        self.listings = 0
+        self.uploads = 0
+        self._next_id = 1
+
+    def patch(self, test_case):
+        for name in ['exchange_oauth2_member', 'upload_stream', 'delete_file', 'download_summaries']:
+            patcher = mock.patch.object(helpers, name, getattr(self, name))
+            patcher.start()
+            test_case.addCleanup(patcher.stop)
+        cache_dir = tempfile.mkdtemp()
+        test_case.addCleanup(shutil.rmtree, cache_dir)
+        summaries_cache = mock.patch.object(helpers, 'summaries_cache', helpers.SummariesCache(cache_dir, 1024 * 1024))
+        summaries_cache.start()
+        test_case.addCleanup(summaries_cache.stop)
+        member_files_cache = mock.patch.object(helpers, 'member_files_cache', MemberFilesCache(60))
+        member_files_cache.start()
+        test_case.addCleanup(member_files_cache.stop)
+
+    def exchange_oauth2_member(self, access_token):
+        self.listings += 1
+        return {'data': [dict(record, download_url=f'fake://{file_id}') for file_id, (record, _) in self.files.items()]}
+
+    def upload_stream(self, body, filename, metadata, access_token, project_member_id):
+        self.uploads += 1
+        file_id = self._next_id
+        self._next_id += 1
+        self.files[file_id] = ({'id': file_id, 'basename': filename, 'metadata': json.loads(json.dumps(metadata))}, b''.join(body))
+        return file_id
+
+    def delete_file(self, access_token, project_member_id, file_id):
+        self.files.pop(file_id, None)
+
+    def download_summaries(self, file):
+        return json.loads(b''.join(decompressed_blocks([self.files[file['id']][1]])))
+
+    def basenames(self):
+        return sorted(record['basename'] for record, _ in self.files.values())
+
+    def summary_ids(self, basename):
+        content = [content for record, content in self.files.values() if record['basename'] == basename][0]
+        return sorted(summary['summaryId'] for summary in json.loads(b''.join(decompressed_blocks([content]))))
+
+
+@override_settings(SUMMARIES_QUIET_SECONDS=0)
+class SummariesRetryTest(TestCase):
+
+    def test_failed_group_backs_off_and_other_groups_go_first(self):
+        worker.save_summaries_for_delayed_processing('dailies-2021-04', 'unknown-user', [summary('1')])
+        worker.save_summaries_for_delayed_processing('dailies-2021-05', 'unknown-user', [summary('2')])
+
+        self.assertEqual(worker.claim_next_summaries('w-1'), ('unknown-user', 'dailies-2021-04'))
+        self.assertFalse(worker.process_summaries_for_user_and_file('dailies-2021-04', 'unknown-user', 'w-1'))
+
+        # Not claimed again right away, the other group goes first
+        self.assertEqual(worker.claim_next_summaries('w-1'), ('unknown-user', 'dailies-2021-05'))
+        worker.release_summaries('dailies-2021-05', 'unknown-user', 'w-1')
+        self.assertEqual(worker.claim_next_summaries('w-1'), ('unknown-user', 'dailies-2021-05'))
+        self.assertAlmostEqual(worker.summaries_retry_countdown('dailies-2021-04', 'unknown-user'), SUMMARIES_RETRY_COUNTDOWN, delta=5)
+
+    def test_backoff_doubles_with_every_failure(self):
+        worker.save_summaries_for_delayed_processing('dailies-2021-04', 'unknown-user', [summary('1')])
+        for failures in range(1, 4):
+            SummariesToProcess.objects.update(retry_after=timezone.now())
+            self.assertIsNotNone(worker.claim_next_summaries('w-1'))
+            worker.process_summaries_for_user_and_file('dailies-2021-04', 'unknown-user', 'w-1')
+            self.assertEqual(SummariesToProcess.objects.get().failures, failures)
+            self.assertAlmostEqual(worker.summaries_retry_countdown('dailies-2021-04', 'unknown-user'),
+                                   SUMMARIES_RETRY_COUNTDOWN * 2 ** (failures - 1), delta=5)
+        self.assertIsNone(worker.claim_next_summaries('w-1'))
+
+
+    @skipUnless(connection.vendor == 'sqlite', "Checks the SQLite query plan")
+    def test_claim_walks_a_large_backlog_in_id_order(self):
+        # A group that failed before and is due again isn't put behind the others
+        SummariesToProcess.objects.bulk_create(
+            [SummariesToProcess(garmin_user_id='unknown-user', file_name='dailies-2021-04', summaries_data=compress_json_string('[]'),
+                                failures=2, retry_after=timezone.now())]
+            + [SummariesToProcess(garmin_user_id=f'user-{i}', file_name='dailies-2021-04', summaries_data=compress_json_string('[]'))
+               for i in range(2000)])
+
+        candidates = worker.ready_summaries(worker.claimable_summaries()).only('id', 'garmin_user_id', 'file_name')[:1]
+        sql, params = candidates.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(f'EXPLAIN QUERY PLAN {sql}', params)
+            plan = [row[-1] for row in cursor.fetchall()]
+        self.assertFalse([step for step in plan if 'TEMP B-TREE' in step], plan)
+        self.assertEqual(worker.claim_next_summaries('w-1'), ('unknown-user', 'dailies-2021-04'))
+
+
+class InlineExecutor(Executor):
+    """Runs the submitted functions right away in the calling thread."""
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+
+@override_settings(SUMMARIES_QUIET_SECONDS=0, SUMMARIES_CLAIM_MODE='user')
+class UserClaimModeTest(TestCase):
+
+    def setUp(self):
+        self.open_humans = FakeOpenHumans()
+        self.open_humans.patch(self)
+        create_member('1', 'garmin-1')
+
+    def test_group_failing_in_the_upload_pool_is_released(self):
+        worker.save_summaries_for_delayed_processing('dailies-2021-04', 'garmin-1', [summary('1')])
+        worker.save_summaries_for_delayed_processing('sleep-2021-04', 'garmin-1', [summary('2')])
+        garmin_user_id, file_names = worker.claim_next_user_summaries('w-1')
+        load_summaries = worker.load_summaries
+
+        def load_summaries_failing_for_dailies(summaries_to_process):
+            if summaries_to_process.file_name == 'dailies-2021-04':
+                raise ValueError("Corrupt summaries")
+            return load_summaries(summaries_to_process)
+
+        with mock.patch.object(worker, 'load_summaries', load_summaries_failing_for_dailies):
+            worker.process_summaries_for_user(file_names, garmin_user_id, 'w-1', InlineExecutor())
+
+        failed = SummariesToProcess.objects.get()
+        self.assertEqual((failed.file_name, failed.status, failed.failures), ('dailies-2021-04', SummariesToProcess.PENDING, 1))
+        self.assertEqual(self.open_humans.basenames(), ['garmin-health-api-sleep-2021-04.json'])
+
+
+class IterSummariesTest(TestCase):
+
+    def test_warns_about_keys_after_the_summaries(self):
+        body = json.dumps({'epochs': [summary('1'), summary('2')], 'deregistrations': []}).encode()
+        with self.assertLogs(level='WARNING') as logs:
+            summaries = list(helpers.iter_summaries(io.BytesIO(body), 'epochs'))
+        self.assertEqual([s['summaryId'] for s in summaries], ['1', '2'])
+        self.assertIn("Found ignored keys ['deregistrations'] in summary file", logs.output[0])
+
+    def test_fails_without_the_summaries(self):
+        with self.assertRaisesMessage(Exception, 'Could not find summaries with name epochs'):
+            list(helpers.iter_summaries(io.BytesIO(b'{"dailies": []}'), 'epochs'))
+
+
+class MemberFilesCacheTest(TestCase):
+
+    def setUp(self):
+        self.open_humans = FakeOpenHumans()
+        self.open_humans.patch(self)
+        self.oh_member = create_member('1', 'garmin-1').member
+
+    def test_burst_for_one_member_lists_files_once(self):
+        for i in range(5):
+            helpers.save_summaries(self.oh_member, [summary(str(i))], 'dailies-2021-04')
+        self.assertEqual(self.open_humans.listings, 1)
+        self.assertEqual(self.open_humans.summary_ids('garmin-health-api-dailies-2021-04.json'), ['0', '1', '2', '3', '4'])
+
+    def test_listing_changed_by_other_process_is_not_used(self):
+        processes = []
+        for _ in range(2):
+            cache_dir = tempfile.mkdtemp()
+            self.addCleanup(shutil.rmtree, cache_dir)
+            processes.append((MemberFilesCache(60), helpers.SummariesCache(cache_dir, 1024 * 1024)))
+        for i, process in enumerate([0, 1, 0, 1]):
+            member_files_cache, summaries_cache = processes[process]
+            with mock.patch.object(helpers, 'member_files_cache', member_files_cache), mock.patch.object(helpers, 'summaries_cache', summaries_cache):
+                helpers.save_summaries(self.oh_member, [summary(str(i))], 'epochs-2021-04')
+
+        self.assertEqual(self.open_humans.basenames(), ['garmin-health-api-epochs-2021-04.json'])
+        self.assertEqual(self.open_humans.summary_ids('garmin-health-api-epochs-2021-04.json'), ['0', '1', '2', '3'])
+
+
+@override_settings(WORKER_MODE='celery')
+class CeleryEagerTest(TestCase):
+    """The webhook -> Celery task -> Open Humans upload path, with the tasks running eagerly instead of through a broker."""
+
+    def setUp(self):
+        self.open_humans = FakeOpenHumans()
+        self.open_humans.patch(self)
+        create_member('1', 'garmin-1')
+        celery_app.conf.update(CELERY_TASK_ALWAYS_EAGER=True)  # The configuration is read from the settings with the CELERY_ prefix
+        self.addCleanup(celery_app.conf.update, CELERY_TASK_ALWAYS_EAGER=settings.CELERY_TASK_ALWAYS_EAGER)
+
+    def post_epochs(self, summaries):
+        body = json.dumps({'epochs': [dict(summary, userId='garmin-1') for summary in summaries]})
+        response = self.client.post('/garmin-endpoint/epochs/', data=body, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+
+    def push_epochs(self, summaries):
+        # The tasks are only queued when the transaction commits, which a TestCase never does
+        with self.captureOnCommitCallbacks(execute=True):
+            self.post_epochs(summaries)
+
+    def test_push_larger_than_a_chunk_is_processed_completely(self):
+        self.push_epochs([summary(str(i), 1618000000 + i) for i in range(2500)])
+
+        self.assertFalse(SummariesToProcess.objects.exists())
+        self.assertEqual(self.open_humans.basenames(), ['garmin-health-api-epochs-2021-04.json'])
+        self.assertEqual(len(self.open_humans.summary_ids('garmin-health-api-epochs-2021-04.json')), 2500)
+
+    def test_uploads_saved_counts_pushes(self):
+        # Not processed yet, a TestCase never commits
+        self.post_epochs([summary(str(i), 1618000000 + i) for i in range(2500)])
+        self.post_epochs([summary('2500', 1618002500)])
+        self.assertEqual(SummariesToProcess.objects.count(), 4)
+        uploads_saved = metrics.get_counters().get('summaries_uploads_saved', 0)
+
+        tasks.process_summaries.apply(('epochs-2021-04', 'garmin-1'))
+
+        self.assertEqual(self.open_humans.uploads, 1)
+        self.assertEqual(metrics.get_counters()['summaries_uploads_saved'] - uploads_saved, 1)
+
+    def test_duplicate_task_leaves_claimed_group_alone(self):
+        worker.save_summaries_for_delayed_processing('epochs-2021-04', 'garmin-1', [summary('1')])
+        self.assertTrue(worker.claim_summaries('epochs-2021-04', 'garmin-1', 'other-worker', coalesce=False))
+
+        with mock.patch('main.tasks.schedule_summaries') as schedule_summaries:
+            tasks.process_summaries.apply(('epochs-2021-04', 'garmin-1'))
+        # The worker holding the claim uploads them and schedules a task for anything that arrives meanwhile
+        schedule_summaries.assert_not_called()
+        self.assertEqual(self.open_humans.uploads, 0)
+        self.assertEqual(SummariesToProcess.objects.get().claimed_by, 'other-worker')
+
+    def test_tasks_for_the_same_group_upload_once(self):
+        worker.save_summaries_for_delayed_processing('epochs-2021-04', 'garmin-1', [summary('1')])
+        worker.save_summaries_for_delayed_processing('epochs-2021-04', 'garmin-1', [summary('2')])
+
+        for _ in range(2):
+            tasks.process_summaries.apply(('epochs-2021-04', 'garmin-1'))
+
+        self.assertEqual(self.open_humans.uploads, 1)
+        self.assertEqual(self.open_humans.summary_ids('garmin-health-api-epochs-2021-04.json'), ['1', '2'])
+
+    def test_summaries_arriving_while_processing_get_a_new_task(self):
+        worker.save_summaries_for_delayed_processing('epochs-2021-04', 'garmin-1', [summary('1')])
+        save_summaries = worker.save_summaries
+        pushes = [[summary('2')]]
+
+        def save_summaries_while_push_arrives(*args, **kwargs):
+            if pushes:
+                worker.save_summaries_for_delayed_processing('epochs-2021-04', 'garmin-1', pushes.pop())
+            return save_summaries(*args, **kwargs)
+
+        with mock.patch.object(worker, 'save_summaries', save_summaries_while_push_arrives), self.captureOnCommitCallbacks(execute=True):
+            tasks.process_summaries.apply(('epochs-2021-04', 'garmin-1'))
+            self.assertEqual(SummariesToProcess.objects.count(), 1)
+
+        self.assertFalse(SummariesToProcess.objects.exists())
+        self.assertEqual(self.open_humans.summary_ids('garmin-health-api-epochs-2021-04.json'), ['1', '2'])
+
+    @override_settings(WEBHOOK_INGEST_MODE='raw')
+    def test_raw_push_is_scheduled_after_commit(self):
+        with mock.patch('main.tasks.process_summaries.apply_async') as apply_async:
+            with self.captureOnCommitCallbacks() as callbacks:
+                self.post_epochs([summary('1')])
+            # process_raw_summaries saves the summaries in a transaction, their task must not run before it commits
+            apply_async.assert_not_called()
+            for callback in callbacks:
+                callback()
+        apply_async.assert_called_once_with(('epochs-2021-04', 'garmin-1'), countdown=settings.SUMMARIES_QUIET_SECONDS)
+
+
+class StubGarminHealth(object):
+    """
+    Local aiohttp server standing in for the Garmin Health API, running its own event loop in a thread. Every summary request
+    gets one summary per uploadStartTimeInSeconds back, after delay seconds.
+    """
+
+    def __init__(self, delay=0, retry_after=None):
+        self.statuses = {}  # access token -> statuses to answer with, one per request, before answering with 200
+        self.requests = []  # (time.monotonic(), access token) of every request
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._delay = delay
+        self._retry_after = retry_after
+
+    def start(self, test_case):
+        loop = asyncio.new_event_loop()
+        app = web.Application()
+        app.router.add_get('/{name}', self.handle)
+        runner = web.AppRunner(app, access_log=None)
+        loop.run_until_complete(runner.setup())
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        loop.run_until_complete(web.SockSite(runner, sock).start())
+        thread = Thread(target=loop.run_forever, daemon=True)
+        thread.start()
+
+        def stop():
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            loop.run_until_complete(runner.cleanup())
+            loop.close()
+
+        test_case.addCleanup(stop)
+        self.base_url = f'http://127.0.0.1:{sock.getsockname()[1]}'
+        urls = mock.patch.dict(async_garmin_health.SUMMARY_URLS, {name: f'{self.base_url}/{name}?' for name in async_garmin_health.SUMMARY_URLS})
+        urls.start()
+        test_case.addCleanup(urls.stop)
+
+    async def handle(self, request):
+        access_token = re.search(r'oauth_token="([^"]*)"', request.headers['Authorization']).group(1)
+        self.requests.append((time.monotonic(), access_token))
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self._delay)
+        finally:
+            self.in_flight -= 1
+
+        statuses = self.statuses.get(access_token)
+        if statuses:
+            headers = {'Retry-After': str(self._retry_after)} if self._retry_after is not None else {}
+            return web.Response(status=statuses.pop(0), headers=headers)
+        start_time = int(request.query['uploadStartTimeInSeconds'])
+        return web.json_response([summary(f"{request.match_info['name']}-{access_token}-{start_time}", start_time)])
+
+
+def garmin_user(access_token):
+    return SimpleNamespace(access_token=access_token, access_token_secret='secret')
+
+
+class AsyncGarminHealthTest(TestCase):
+
+    def start_stub(self, **kwargs):
+        stub = StubGarminHealth(**kwargs)
+        stub.start(self)
+        return stub
+
+    def test_invalid_token_fails_only_its_user(self):
+        stub = self.start_stub()
+        stub.statuses['token-2'] = [403]
+        user_1, user_2 = garmin_user('token-1'), garmin_user('token-2')
+
+        results = pull_summaries('key', 'secret', [user_1, user_2], ['dailies'], 1618000000, 1618003600)
+
+        self.assertEqual(results[0], (user_1, 'dailies', [summary('dailies-token-1-1618000000', 1618000000)]))
+        self.assertIs(results[1][0], user_2)
+        self.assertIsInstance(results[1][2], GarminHealthFatalException)
+        self.assertEqual([access_token for _, access_token in stub.requests].count('token-2'), 1)
+
+    def test_requests_in_flight_are_capped(self):
+        stub = self.start_stub(delay=0.05)
+        users = [garmin_user(f'token-{i}') for i in range(6)]
+
+        results = pull_summaries('key', 'secret', users, ['dailies', 'sleep'], 1618000000, 1618003600, max_concurrency=3, user_rate=100)
+
+        self.assertEqual(len(stub.requests), 12)
+        self.assertEqual(stub.max_in_flight, 3)
+        self.assertTrue(all(len(summaries) == 1 for _, _, summaries in results))
+
+    def test_requests_for_one_user_are_spaced(self):
+        self.start_stub()
+        # Record when the client sends, the server's receive times are subject to scheduling delays
+        times = []
+        wait_for_user = AsyncGarminHealth._wait_for_user
+
+        async def recording_wait_for_user(garmin_health, user):
+            await wait_for_user(garmin_health, user)
+            times.append(time.monotonic())
+
+        # Three days are three chunks, all for the same user
+        with mock.patch.object(AsyncGarminHealth, '_wait_for_user', recording_wait_for_user):
+            results = pull_summaries('key', 'secret', [garmin_user('token-1')], ['dailies'], 1618000000, 1618000000 + 3 * 86400, user_rate=10)
+
+        self.assertEqual(len(results[0][2]), 3)
+        self.assertEqual(len(times), 3)
+        self.assertTrue(all(later - earlier >= 0.1 - 0.005 for earlier, later in zip(times, times[1:])), times)
+
+    def test_throttled_request_waits_for_retry_after(self):
+        stub = self.start_stub(retry_after=0.3)
+        stub.statuses['token-1'] = [429]
+
+        results = pull_summaries('key', 'secret', [garmin_user('token-1')], ['dailies'], 1618000000, 1618003600)
+
+        self.assertEqual(len(results[0][2]), 1)
+        (first_request, _), (second_request, _) = stub.requests
+        self.assertGreaterEqual(second_request - first_request, 0.3)
+
+    def test_only_retryable_statuses_are_retried(self):
+        stub = self.start_stub()
+        stub.statuses = {'token-1': [503, 502], 'token-2': [400], 'token-3': [503, 503, 503]}
+        users = [garmin_user(f'token-{i}') for i in range(1, 4)]
+        retry_policy = RetryPolicy('garmin', max_attempts=3, base_delay=0.01)
+
+        results = pull_summaries('key', 'secret', users, ['dailies'], 1618000000, 1618003600, user_rate=100, retry_policy=retry_policy)
+
+        self.assertEqual(len(results[0][2]), 1)
+        self.assertIsInstance(results[1][2], GarminHealthFatalException)
+        self.assertIsInstance(results[2][2], GarminHealthFatalException)
+        request_counts = Counter(access_token for _, access_token in stub.requests)
+        self.assertEqual(request_counts, {'token-1': 3, 'token-2': 1, 'token-3': 3})
+
+    def test_pull_summaries_command_saves_them_for_processing(self):
+        self.start_stub()
+        create_member('1', 'garmin-1', access_token='token-1', has_health_export_permission=True)
+        create_member('2', 'garmin-2', access_token='token-2', has_health_export_permission=False)
+
+        call_command('pull_summaries', '--days', '2', '--end', '1618172800', '--summaries', 'dailies', stdout=io.StringIO())
+
+        summaries_to_process = SummariesToProcess.objects.get()
+        self.assertEqual((summaries_to_process.garmin_user_id, summaries_to_process.file_name), ('garmin-1', 'dailies-2021-04'))
+        self.assertEqual(sorted(summary['summaryId'] for summary in worker.load_summaries(summaries_to_process)),
+                         ['dailies-token-1-1618000000', 'dailies-token-1-1618086400'])
+
+
+class GarminHealthTest(TestCase):
+
+    def test_iter_summaries_signs_with_a_session_per_thread(self):
+        stub = StubGarminHealth(delay=0.02)
+        stub.start(self)
+        garmin = GarminHealth('key', 'secret')
+        garmin.oauth = oauth1_session(client_key='key', client_secret='secret', resource_owner_key='token-1', resource_owner_secret='secret')
+        sessions = []
+
+        def copy_oauth_session():
+            sessions.append(GarminHealth.copy_oauth_session(garmin))
+            return sessions[-1]
+
+        with mock.patch.object(garmin.oauth, 'request', side_effect=AssertionError("Shared session used")), \
+                mock.patch.object(garmin, 'copy_oauth_session', copy_oauth_session):
+            summaries = list(garmin.iter_summaries(f'{stub.base_url}/dailies?', 1618000000, 1618000000 + 8 * 86400, max_workers=4))
+
+        self.assertEqual([summary['startTimeInSeconds'] for summary in summaries], [1618000000 + day * 86400 for day in range(8)])
+        self.assertEqual(len(sessions), len(set(map(id, sessions))))
+        self.assertLessEqual(len(sessions), 4)
+        self.assertEqual({access_token for _, access_token in stub.requests}, {'token-1'})
+
+
+@override_settings(SUMMARIES_QUIET_SECONDS=0)
+class ReencodeFilesTest(TransactionTestCase):
+    """Without the transaction of a TestCase, so the files are re-encoded in a thread that sees the database of the test."""
+
+    def setUp(self):
+        self.open_humans = FakeOpenHumans()
+        self.open_humans.patch(self)
+        exchange_oauth2_member = mock.patch('main.management.commands.reencode_files.exchange_oauth2_member', self.open_humans.exchange_oauth2_member)
+        exchange_oauth2_member.start()
+        self.addCleanup(exchange_oauth2_member.stop)
+        self.oh_member = create_member('1', 'garmin-1').member
+        helpers.save_summaries(self.oh_member, [summary('1')], 'dailies-2021-04')
+
+    def reencode_files(self):
+        stdout = io.StringIO()
+        call_command('reencode_files', '--format', 'gzip', '--threads', '1', stdout=stdout)
+        return stdout.getvalue()
+
+    def test_workers_wait_for_held_summaries(self):
+        self.assertTrue(worker.hold_summaries('dailies-2021-04', 'garmin-1', 'reencode'))
+        worker.save_summaries_for_delayed_processing('dailies-2021-04', 'garmin-1', [summary('2')])
+        self.assertIsNone(worker.claim_next_summaries('w-1'))
+        self.assertFalse(worker.hold_summaries('dailies-2021-04', 'garmin-1', 'reencode-2'))
+
+        worker.release_held_summaries('dailies-2021-04', 'garmin-1', 'reencode')
+        self.assertEqual(worker.claim_next_summaries('w-1'), ('garmin-1', 'dailies-2021-04'))
+
+    def test_file_the_worker_is_processing_is_skipped(self):
+        worker.save_summaries_for_delayed_processing('dailies-2021-04', 'garmin-1', [summary('2')])
+        self.assertEqual(worker.claim_next_summaries('w-1'), ('garmin-1', 'dailies-2021-04'))
+
+        self.assertIn('Re-encoded 0 files as gzip, 0 failed, skipped 1', self.reencode_files())
+        self.assertEqual(self.open_humans.basenames(), ['garmin-health-api-dailies-2021-04.json'])
+
+        self.assertTrue(worker.process_summaries_for_user_and_file('dailies-2021-04', 'garmin-1', 'w-1'))
+        self.assertIn('Re-encoded 1 files as gzip, 0 failed, skipped 0', self.reencode_files())
+        self.assertEqual(self.open_humans.basenames(), ['garmin-health-api-dailies-2021-04.json.gz'])
+        self.assertEqual(self.open_humans.summary_ids('garmin-health-api-dailies-2021-04.json.gz'), ['1', '2'])
+        self.assertFalse(SummariesToProcess.objects.exists())
+
+    @override_settings(WORKER_MODE='celery')
+    def test_summaries_arriving_while_held_are_scheduled_on_release(self):
+        def push_during_reencode(*args):
+            worker.save_summaries_for_delayed_processing('dailies-2021-04', 'garmin-1', [summary('2')])
+            return reencode_file(*args)
+
+        reencode_file = helpers.reencode_file
+        with mock.patch('main.management.commands.reencode_files.reencode_file', push_during_reencode), \
+                mock.patch('main.worker.schedule_summaries') as schedule_summaries:
+            self.reencode_files()
+
+        schedule_summaries.assert_called_once_with('dailies-2021-04', 'garmin-1')
+        self.assertEqual(SummariesToProcess.objects.get().status, SummariesToProcess.PENDING)
+
+
+    def test_leases_of_held_summaries_are_renewed(self):
+        leases = []
+
+        def slow_reencode_file(*args):
+            leases.append(SummariesToProcess.objects.get().lease_expires_at)
+            time.sleep(0.3)
+            leases.append(SummariesToProcess.objects.get().lease_expires_at)
+            return reencode_file(*args)
+
+        reencode_file = helpers.reencode_file
+        with mock.patch('main.management.commands.reencode_files.reencode_file', slow_reencode_file), \
+                mock.patch('main.management.commands.reencode_files.SUMMARIES_HEARTBEAT_SECONDS', 0.05):
+            self.assertIn('Re-encoded 1 files as gzip', self.reencode_files())
+
+        self.assertGreater(leases[1], leases[0])
+        self.assertFalse(SummariesToProcess.objects.exists())
+
+
+class BenchmarkCommandTest(TransactionTestCase):
+    """Without the transaction of a TestCase, so the worker thread of the wakeup benchmark sees the database of the test."""
+
+    def test_all_benchmarks_run(self):
+        stdout = io.StringIO()
+        call_command('benchmark', '--sizes', '100', '--payload-mb', '1', '--rows', '2', '--requests', '5', '--idle-seconds', '0.1', '--posts', '1', stdout=stdout)
+        self.assertEqual(stdout.getvalue().count('## '), len(benchmark.Command.BENCHMARKS))
+        self.assertFalse(SummariesToProcess.objects.exists())
@@ -15,7 +15,7 @@ from openhumans.models import OpenHumansMember
 
 from .garmin_health import GarminHealth
 from .models import GarminMember, RetrievedData
-from .worker import handle_summaries_delayed
+from .worker import receive_summaries, schedule_backfill
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -86,6 +86,8 @@ def complete_garmin(request, resource_owner_secret):
         garmin_member.was_backfilled = False
         garmin_member.has_health_export_permission = True
         garmin_member.save()
+        garmin_member.backfill_cursors.all().delete()  # Backfill again from now
+        schedule_backfill(garmin_member)
 
     return redirect('/')
 
@@ -119,6 +121,8 @@ def garmin_user_permissions_change(request):
             garmin_member = GarminMember.objects.get(userid=user_id)
             garmin_member.has_health_export_permission = 'HEALTH_EXPORT' in permissions
             garmin_member.save()
+            if garmin_member.has_health_export_permission and not garmin_member.was_backfilled:
+                schedule_backfill(garmin_member)
         except ObjectDoesNotExist:
             _LOGGER.info("Ignoring permission change for unknown user " + user_id)
     return HttpResponse(status=200)
@@ -127,7 +131,7 @@ def garmin_user_permissions_change(request):
 @csrf_exempt
 @require_http_methods(["POST"])
 def garmin_body_composition(request):
-    handle_summaries_delayed(request.body, 'bodyComps', "body-composition")
+    receive_summaries(request, 'bodyComps', "body-composition")
 
     return HttpResponse(status=200)
 
@@ -135,7 +139,7 @@ def garmin_body_composition(request):
 @csrf_exempt
 @require_http_methods(["POST"])
 def garmin_dailies(request):
-    handle_summaries_delayed(request.body, 'dailies', "dailies", ['activityType'])  # We remove activityType to avoid confusion. It's a legacy field that always has the value 'WALKING'
+    receive_summaries(request, 'dailies', "dailies", ['activityType'])  # We remove activityType to avoid confusion. It's a legacy field that always has the value 'WALKING'
 
     return HttpResponse(status=200)
 
@@ -143,7 +147,7 @@ def garmin_dailies(request):
 @csrf_exempt
 @require_http_methods(["POST"])
 def garmin_epochs(request):
-    handle_summaries_delayed(request.body, 'epochs', "epochs")
+    receive_summaries(request, 'epochs', "epochs")
 
     return HttpResponse(status=200)
 
@@ -151,7 +155,7 @@ def garmin_epochs(request):
 @csrf_exempt
 @require_http_methods(["POST"])
 def garmin_pulse_ox(request):
-    handle_summaries_delayed(request.body, 'pulseox', "pulse-ox")
+    receive_summaries(request, 'pulseox', "pulse-ox")
 
     return HttpResponse(status=200)
 
@@ -159,7 +163,7 @@ def garmin_pulse_ox(request):
 @csrf_exempt
 @require_http_methods(["POST"])
 def garmin_respiration(request):
-    handle_summaries_delayed(request.body, 'allDayRespiration', "respiration")
+    receive_summaries(request, 'allDayRespiration', "respiration")
 
     return HttpResponse(status=200)
 
@@ -167,7 +171,7 @@ def garmin_respiration(request):
 @csrf_exempt
 @require_http_methods(["POST"])
 def garmin_sleeps(request):
-    handle_summaries_delayed(request.body, 'sleeps', "sleep")
+    receive_summaries(request, 'sleeps', "sleep")
 
     return HttpResponse(status=200)
 
@@ -175,7 +179,7 @@ def garmin_sleeps(request):
 @csrf_exempt
 @require_http_methods(["POST"])
 def garmin_stress(request):
-    handle_summaries_delayed(request.body, 'stressDetails', "stress")
+    receive_summaries(request, 'stressDetails', "stress")
 
     return HttpResponse(status=200)
 
@@ -183,7 +187,7 @@ def garmin_stress(request):
 @csrf_exempt
 @require_http_methods(["POST"])
 def garmin_third_party_dailies(request):
-    handle_summaries_delayed(request.body, 'thirdPartyDetails', "third-party")  # I (Koen) could not test this since I don't have this data...
+    receive_summaries(request, 'thirdPartyDetails', "third-party")  # I (Koen) could not test this since I don't have this data...
 
     return HttpResponse(status=200)
 
@@ -191,6 +195,6 @@ def garmin_third_party_dailies(request):
 @csrf_exempt
 @require_http_methods(["POST"])
 def garmin_user_metrics(request):
-    handle_summaries_delayed(request.body, 'userMetrics', "user-metrics")
+    receive_summaries(request, 'userMetrics', "user-metrics")
 
     return HttpResponse(status=200)
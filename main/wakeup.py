@@ -0,0 +1,111 @@
+import logging
+import select
+import time
+from threading import Condition
+
+from django.db import connection
+
+from .consts import WORKER_IDLE_MIN_SLEEP, WORKER_IDLE_MAX_SLEEP, WORKER_IDLE_MAX_SLEEP_WITHOUT_NOTIFY
+
+SUMMARIES_CHANNEL = 'garmin_summaries'
+BACKFILL_CHANNEL = 'garmin_backfill'
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class Wakeup(object):
+    """Lets idle worker threads sleep until new work is announced on a channel."""
+
+    def __init__(self):
+        self._condition = Condition()
+        self._generation = 0
+
+    @property
+    def generation(self):
+        return self._generation
+
+    def notify(self):
+        with self._condition:
+            self._generation += 1
+            self._condition.notify_all()
+
+    def wait(self, timeout, generation):
+        """
+        Wait until notified or until the timeout expires.
+
+        :param generation: value of `generation` read before looking for work, so that a notification sent
+            in between isn't lost
+        """
+        with self._condition:
+            return self._condition.wait_for(lambda: self._generation != generation, timeout)
+
+
+_wakeups = {
+    SUMMARIES_CHANNEL: Wakeup(),
+    BACKFILL_CHANNEL: Wakeup(),
+}
+
+
+def get_wakeup(channel):
+    return _wakeups[channel]
+
+
+def supports_notify():
+    return connection.vendor == 'postgresql'
+
+
+def max_idle_sleep():
+    return WORKER_IDLE_MAX_SLEEP if supports_notify() else WORKER_IDLE_MAX_SLEEP_WITHOUT_NOTIFY
+
+
+def next_idle_sleep(idle_sleep):
+    if idle_sleep is None:
+        return WORKER_IDLE_MIN_SLEEP
+    return min(idle_sleep * 2, max_idle_sleep())
+
+
+def notify(channel):
+    """Wake up the workers listening on channel, in this process and (on Postgres) in all worker processes."""
+    if supports_notify():
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_notify(%s, '')", [channel])
+    get_wakeup(channel).notify()
+
+
+def notify_all_local():
+    for wakeup in _wakeups.values():
+        wakeup.notify()
+
+
+def listen_for_notifications(is_terminated):
+    """
+    Forward Postgres notifications to the local wakeups. Runs in its own thread with a dedicated connection, until
+    is_terminated() returns True. If the connection fails, the workers just keep polling with their idle backoff.
+    """
+    if not supports_notify():
+        return
+
+    while not is_terminated():
+        listen_connection = None
+        try:
+            listen_connection = connection.get_new_connection(connection.get_connection_params())
+            listen_connection.autocommit = True
+            with listen_connection.cursor() as cursor:
+                for channel in _wakeups.keys():
+                    cursor.execute(f"LISTEN {channel}")
+            # New work may have been announced while we weren't listening
+            notify_all_local()
+
+            while not is_terminated():
+                if select.select([listen_connection], [], [], 1.0) == ([], [], []):
+                    continue
+                listen_connection.poll()
+                while listen_connection.notifies:
+                    notification = listen_connection.notifies.pop(0)
+                    get_wakeup(notification.channel).notify()
+        except Exception as e:
+            _LOGGER.error(f"Listening for notifications failed, retrying: {e}")
+            time.sleep(WORKER_IDLE_MAX_SLEEP_WITHOUT_NOTIFY)
+        finally:
+            if listen_connection is not None:
+                listen_connection.close()
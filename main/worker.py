@@ -1,184 +1,563 @@
 import json
 import logging
+import multiprocessing
+import os
 import signal
+import socket
 import sys
 import time
 import traceback
+import uuid
+from collections import defaultdict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from datetime import datetime, timedelta
-from threading import Lock, Thread
+from threading import Thread, current_thread
 
 import pytz
 from django.conf import settings
-from django.core.exceptions import ObjectDoesNotExist
-from requests_oauthlib import OAuth1Session
+from django.db import IntegrityError, connection, connections, transaction
+from django.db.models import DateTimeField, Exists, Max, OuterRef, Q, Subquery, Sum, Value
+from django.db.models.functions import Greatest, Least
+from django.utils import timezone
 
 from oh_template.settings import NUM_OF_SUMMARY_UPLOAD_THREADS
-from .consts import BACKFILL_SECONDS, BACKFILL_MIN_YEAR, GARMIN_BACKFILL_URLS, BACKFILL_SLEEP_BETWEEN_CALLS
-from .helpers import unix_time_seconds, merge_with_existing_and_upload, get_oh_user_from_garmin_id, group_summaries_per_user_and_per_month, extract_summaries, remove_fields, summaries_to_process_key, \
-    remove_unwanted_fields, extract_timestamp
-from .models import GarminMember, SummariesToProcess, RetrievedData
+from .backfill import BackfillScheduler
+from .consts import SUMMARIES_CHUNK_SIZE, SUMMARIES_MAX_BUFFERED, SUMMARIES_LEASE_SECONDS, SUMMARIES_HEARTBEAT_SECONDS, SUMMARIES_RETRY_COUNTDOWN, \
+    SUMMARIES_MAX_RETRY_COUNTDOWN
+from .helpers import save_summaries, get_member_files, get_oh_user_from_garmin_id, group_summaries_per_user_and_per_month, iter_summaries, iter_batches, \
+    remove_fields, remove_unwanted_fields
+from . import metrics
+from .compression import compress_stream, DecompressingStream, compress_json_string, decompress_json
+from .models import SummariesToProcess, RetrievedData, RawSummariesToProcess
+from .month_buckets import summary_epochs
+from .wakeup import SUMMARIES_CHANNEL, BACKFILL_CHANNEL, get_wakeup, next_idle_sleep, notify, notify_all_local, listen_for_notifications
 
 utc = pytz.UTC
 
 _LOGGER = logging.getLogger(__name__)
 
-handle_summaries_lock = Lock()
-locked_summaries = []
 process_terminated = False
 
 
 def terminate_process(signum, frame):
     global process_terminated
     process_terminated = True
+    notify_all_local()  # Don't let idle threads sleep through the shutdown
 
 
-def start_worker_threads():
+def is_process_terminated():
+    return process_terminated
+
+
+def start_worker_processes(num_processes, with_backfill=True):
+    """
+    Run the worker in num_processes forked processes. Processes (also on other machines) coordinate through the leases
+    on SummariesToProcess, so they can safely share the backlog. Only the first process runs the backfill thread.
+    """
+    if num_processes <= 1:
+        run_worker(with_backfill)
+        return
+
     signal.signal(signal.SIGINT, terminate_process)
     signal.signal(signal.SIGTERM, terminate_process)
 
-    backfill_thread = Thread(target=handle_backfill)
-    backfill_thread.start()
+    # Database connections can't be shared with the forked processes
+    connections.close_all()
+    context = multiprocessing.get_context('fork')
+    processes = [context.Process(target=run_worker, args=(with_backfill and i == 0,), name=f"worker-{i}") for i in range(num_processes)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+
+def run_worker(with_backfill=True):
+    for thread in start_worker_threads(with_backfill):
+        thread.join()
+
 
+def start_worker_threads(with_backfill=True):
+    signal.signal(signal.SIGINT, terminate_process)
+    signal.signal(signal.SIGTERM, terminate_process)
+
+    threads = [Thread(target=handle_heartbeats), Thread(target=listen_for_notifications, args=(is_process_terminated,))]
+    if with_backfill:
+        threads.append(Thread(target=handle_backfill))
+    upload_pool = None
+    if settings.SUMMARIES_CLAIM_MODE == 'user':
+        # Shared by the members the handle_summaries threads claimed, see process_summaries_for_user
+        upload_pool = ThreadPoolExecutor(settings.SUMMARIES_UPLOAD_POOL_THREADS, thread_name_prefix='summaries-upload')
     for i in range(NUM_OF_SUMMARY_UPLOAD_THREADS):
-        thread = Thread(target=handle_summaries)
+        threads.append(Thread(target=handle_summaries, args=(upload_pool,)))
+
+    for thread in threads:
         thread.start()
+    return threads
 
 
 def handle_backfill():
-    while not process_terminated:
-        try:
-            garmin_member = GarminMember.objects.get(was_backfilled=False, userid__isnull=False, has_health_export_permission=True)
-            handle_backfill_for_member(garmin_member)
-        except ObjectDoesNotExist:
-            # Nothing to do
-            time.sleep(0.5)
+    BackfillScheduler(is_process_terminated).run()
 
 
-def handle_backfill_for_member(garmin_member):
-    oauth = OAuth1Session(
-        client_key=settings.GARMIN_KEY,
-        client_secret=settings.GARMIN_SECRET,
-        resource_owner_key=garmin_member.access_token,
-        resource_owner_secret=garmin_member.access_token_secret
-    )
-    end_date = datetime.utcnow()
-    start_date = end_date - timedelta(seconds=BACKFILL_SECONDS)
-    _LOGGER.info(f"Executing backfill for user {get_oh_user_from_garmin_id(garmin_member.userid)}")
-    while start_date.year >= BACKFILL_MIN_YEAR:
-
-        start_epoch = unix_time_seconds(start_date)
-        end_epoch = unix_time_seconds(end_date)
-
-        for url in GARMIN_BACKFILL_URLS:
-            if process_terminated:
-                return  # Terminate this thread
-            summary_url = f"{url}?summaryStartTimeInSeconds={start_epoch}&summaryEndTimeInSeconds={end_epoch}"
-            res = oauth.get(url=summary_url)
-            if res.status_code != 202:
-                _LOGGER.error(f"Invalid response for backfill url {summary_url}, got response response: {res.content},{res.status_code}")
-                # Failed to call all backfill's !!
-                if res.status_code == 403:
-                    # Something is wrong with the user authorisation token. He might have removed the authorization...
-                    garmin_member.has_health_export_permission = False
-                    garmin_member.save()
-                # We'll stop executing them for this user, in the next run of the handle_backfill thread,
-                # this function will be called again for this user (if it's authorized), since was_backfilled is still False
-                return
-            else:
-                _LOGGER.info(f"Called backfill {summary_url}")
+def get_worker_process_id():
+    return f"{socket.gethostname()}-{os.getpid()}"
 
-            time.sleep(BACKFILL_SLEEP_BETWEEN_CALLS)
 
-        end_date = start_date
-        start_date = start_date - timedelta(seconds=BACKFILL_SECONDS)
-    garmin_member.was_backfilled = True
-    garmin_member.save()
-    _LOGGER.info(f"Backfill finished for user {get_oh_user_from_garmin_id(garmin_member.userid)}")
+def get_worker_id():
+    return f"{get_worker_process_id()}-{current_thread().name}"
 
 
-def handle_summaries():
+def lease_expiry():
+    return timezone.now() + timedelta(seconds=SUMMARIES_LEASE_SECONDS)
+
+
+def handle_heartbeats():
+    last_heartbeat = 0
     while not process_terminated:
-        not_locked_summaries = None
-        with handle_summaries_lock:
-            for summaries_to_process in SummariesToProcess.objects.all():
-                if summaries_to_process_key(summaries_to_process) not in locked_summaries:
-                    not_locked_summaries = summaries_to_process
-                    break
-
-            if not_locked_summaries is not None:
-                key = summaries_to_process_key(not_locked_summaries)
-                locked_summaries.append(key)
-
-        if not_locked_summaries is not None:
-            try:
-                process_summaries_for_user_and_file(not_locked_summaries.file_name, not_locked_summaries.garmin_user_id)
-            finally:
-                locked_summaries.remove(summaries_to_process_key(not_locked_summaries))
+        if time.monotonic() - last_heartbeat >= SUMMARIES_HEARTBEAT_SECONDS:
+            renew_leases(get_worker_process_id())
+            release_expired_leases()
+            metrics.log_counters()
+            last_heartbeat = time.monotonic()
+        time.sleep(0.5)
+
+
+def renew_leases(worker_process_id):
+    SummariesToProcess.objects.filter(status=SummariesToProcess.CLAIMED, claimed_by__startswith=f"{worker_process_id}-").update(lease_expires_at=lease_expiry())
+    RawSummariesToProcess.objects.filter(status=RawSummariesToProcess.CLAIMED, claimed_by__startswith=f"{worker_process_id}-").update(lease_expires_at=lease_expiry())
+
+
+def release_expired_leases():
+    # Claims of worker processes that died (or lost their database connection) without releasing them
+    released = SummariesToProcess.objects.filter(status=SummariesToProcess.CLAIMED, lease_expires_at__lt=timezone.now()) \
+        .update(status=SummariesToProcess.PENDING, claimed_by=None, claimed_at=None, lease_expires_at=None)
+    released += RawSummariesToProcess.objects.filter(status=RawSummariesToProcess.CLAIMED, lease_expires_at__lt=timezone.now()) \
+        .update(status=RawSummariesToProcess.PENDING, claimed_by=None, lease_expires_at=None)
+    if released > 0:
+        _LOGGER.warning(f"Released {released} summaries with an expired lease")
+
+
+def claimable_summaries():
+    """
+    Pending rows that are the oldest pending row of a (garmin_user_id, file_name) group that no other worker is processing.
+    Only the oldest pending row of a group is a candidate, so two workers can never pick the same group at the same time.
+    Groups that failed before wait until their retry_after. They aren't ordered after the other groups: sorting on anything
+    but the id sorts all candidates on every claim, instead of walking the (status, id) index up to the first one.
+    """
+    same_group = SummariesToProcess.objects.filter(garmin_user_id=OuterRef('garmin_user_id'), file_name=OuterRef('file_name'))
+    return SummariesToProcess.objects.filter(
+        ~Exists(same_group.filter(status=SummariesToProcess.CLAIMED)),
+        ~Exists(same_group.filter(status=SummariesToProcess.PENDING, id__lt=OuterRef('id'))),
+        Q(retry_after__isnull=True) | Q(retry_after__lte=timezone.now()),
+        status=SummariesToProcess.PENDING,
+    ).order_by('id')
+
+
+def ready_summaries(candidates):
+    """
+    Only keep the groups that are ready to be processed according to the coalescing settings: Garmin often pushes
+    many small batches for the same file in quick succession, and each processed group costs a full download,
+    merge and upload of the monthly file.
+    """
+    now = timezone.now()
+    pending_group = SummariesToProcess.objects.filter(garmin_user_id=OuterRef('garmin_user_id'), file_name=OuterRef('file_name'), status=SummariesToProcess.PENDING)
+    pending_totals = pending_group.order_by().values('garmin_user_id', 'file_name')
+    return candidates.annotate(
+        pending_count=Subquery(pending_totals.annotate(total=Sum('summaries_count')).values('total')),
+        pending_bytes=Subquery(pending_totals.annotate(total=Sum('size_bytes')).values('total')),
+    ).filter(
+        ~Exists(pending_group.filter(received_at__gt=now - timedelta(seconds=settings.SUMMARIES_QUIET_SECONDS)))
+        | Q(received_at__lte=now - timedelta(seconds=settings.SUMMARIES_MAX_STALENESS_SECONDS))  # The candidate is the oldest pending row
+        | Q(pending_count__gte=settings.SUMMARIES_MAX_COUNT)
+        | Q(pending_bytes__gte=settings.SUMMARIES_MAX_BYTES)
+    )
 
+
+def claim_next_summaries(worker_id):
+    """
+    Claim all pending rows of the oldest group that no other worker is processing.
+    Returns a (garmin_user_id, file_name) tuple, or None if there is nothing to claim.
+    """
+    return claim_group(ready_summaries(claimable_summaries()), worker_id)
+
+
+def claim_summaries(file_name, garmin_user_id, worker_id, coalesce=True):
+    """Claim all pending rows for garmin_user_id and file_name. Returns False if they aren't ready or another worker is processing them."""
+    candidates = claimable_summaries().filter(garmin_user_id=garmin_user_id, file_name=file_name)
+    if coalesce:
+        candidates = ready_summaries(candidates)
+    return claim_group(candidates, worker_id) is not None
+
+
+def is_summaries_claimed(file_name, garmin_user_id):
+    return SummariesToProcess.objects.filter(garmin_user_id=garmin_user_id, file_name=file_name, status=SummariesToProcess.CLAIMED).exists()
+
+
+def claim_group(candidates, worker_id):
+    if connection.features.has_select_for_update_skip_locked:
+        # Postgres: don't wait for rows another worker is claiming right now, just take the next group
+        candidates = candidates.select_for_update(skip_locked=True)
+
+    with transaction.atomic():
+        head = candidates.only('id', 'garmin_user_id', 'file_name').first()
+        if head is None:
+            return None
+
+        claim = {'status': SummariesToProcess.CLAIMED, 'claimed_by': worker_id, 'claimed_at': timezone.now(), 'lease_expires_at': lease_expiry()}
+        # Compare-and-set on the head row. This is what makes claiming safe on databases without row locks (SQLite)
+        if SummariesToProcess.objects.filter(id=head.id, status=SummariesToProcess.PENDING).update(**claim) == 0:
+            return None  # Another worker was faster
+        SummariesToProcess.objects.filter(garmin_user_id=head.garmin_user_id, file_name=head.file_name, status=SummariesToProcess.PENDING).update(**claim)
+
+    return head.garmin_user_id, head.file_name
+
+
+def claim_next_user_summaries(worker_id):
+    """
+    Claim all ready groups of the member with the oldest ready group, in a fixed number of queries.
+    Returns a (garmin_user_id, [file_name, ...]) tuple, or None if there is nothing to claim.
+    """
+    candidates = ready_summaries(claimable_summaries())
+    if connection.features.has_select_for_update_skip_locked:
+        candidates = candidates.select_for_update(skip_locked=True)
+
+    with transaction.atomic():
+        head = candidates.only('id', 'garmin_user_id').first()
+        if head is None:
+            return None
+        garmin_user_id = head.garmin_user_id
+        head_ids = [head.id for head in candidates.filter(garmin_user_id=garmin_user_id).only('id')]
+
+        claim = {'status': SummariesToProcess.CLAIMED, 'claimed_by': worker_id, 'claimed_at': timezone.now(), 'lease_expires_at': lease_expiry()}
+        # Compare-and-set on the head rows, like claim_group. Groups of which another worker was faster are skipped.
+        SummariesToProcess.objects.filter(id__in=head_ids, status=SummariesToProcess.PENDING).update(**claim)
+        file_names = list(SummariesToProcess.objects.filter(id__in=head_ids, claimed_by=worker_id).values_list('file_name', flat=True))
+        SummariesToProcess.objects.filter(garmin_user_id=garmin_user_id, file_name__in=file_names, status=SummariesToProcess.PENDING).update(**claim)
+
+    if len(file_names) == 0:
+        return None
+    return garmin_user_id, file_names
+
+
+def has_pending_summaries(file_name, garmin_user_id):
+    return SummariesToProcess.objects.filter(garmin_user_id=garmin_user_id, file_name=file_name, status=SummariesToProcess.PENDING).exists()
+
+
+def release_summaries(file_name, garmin_user_id, worker_id, failed=False):
+    """
+    Give the claimed rows back. If processing them failed, the group is only claimed again after SUMMARIES_RETRY_COUNTDOWN,
+    doubling with every failure in a row. Returns the seconds until the group can be claimed again.
+    """
+    claimed = SummariesToProcess.objects.filter(garmin_user_id=garmin_user_id, file_name=file_name, claimed_by=worker_id)
+    release = {'status': SummariesToProcess.PENDING, 'claimed_by': None, 'claimed_at': None, 'lease_expires_at': None}
+    countdown = 0
+    if failed:
+        failures = (claimed.aggregate(failures=Max('failures'))['failures'] or 0) + 1
+        countdown = min(SUMMARIES_RETRY_COUNTDOWN * 2 ** (failures - 1), SUMMARIES_MAX_RETRY_COUNTDOWN)
+        release.update(failures=failures, retry_after=timezone.now() + timedelta(seconds=countdown))
+    claimed.update(**release)
+    return countdown
+
+
+def summaries_retry_countdown(file_name, garmin_user_id):
+    """Seconds until the pending rows of the group can be claimed again after a failure, 0 if they can be claimed now."""
+    retry_after = SummariesToProcess.objects.filter(garmin_user_id=garmin_user_id, file_name=file_name, status=SummariesToProcess.PENDING) \
+        .aggregate(retry_after=Max('retry_after'))['retry_after']
+    return max(0, (retry_after - timezone.now()).total_seconds()) if retry_after is not None else 0
+
+
+def hold_summaries(file_name, garmin_user_id, worker_id):
+    """
+    Keep the workers away from garmin_user_id and file_name while something else replaces its file, like reencode_files.
+    Summaries arriving meanwhile wait until release_held_summaries. Returns False if a worker is processing them already.
+    """
+    with transaction.atomic():
+        if is_summaries_claimed(file_name, garmin_user_id):
+            return False
+        # An empty claimed row, claimable_summaries skips groups with a claimed row. If its lease expires, it merges no summaries.
+        SummariesToProcess.objects.create(garmin_user_id=garmin_user_id, file_name=file_name, summaries_data=compress_json_string('[]'),
+                                          status=SummariesToProcess.CLAIMED, claimed_by=worker_id, claimed_at=timezone.now(), lease_expires_at=lease_expiry())
+
+    # A worker that found the group claimable just before may have claimed it in the meantime
+    if SummariesToProcess.objects.filter(garmin_user_id=garmin_user_id, file_name=file_name, status=SummariesToProcess.CLAIMED).exclude(claimed_by=worker_id).exists():
+        release_held_summaries(file_name, garmin_user_id, worker_id)
+        return False
+    return True
+
+
+def release_held_summaries(file_name, garmin_user_id, worker_id):
+    SummariesToProcess.objects.filter(garmin_user_id=garmin_user_id, file_name=file_name, claimed_by=worker_id).delete()
+    if has_pending_summaries(file_name, garmin_user_id):
+        # Their task gave up on the group while it was held
+        if use_celery():
+            schedule_summaries(file_name, garmin_user_id)
+        else:
+            notify(SUMMARIES_CHANNEL)
+
+
+def handle_summaries(upload_pool=None):
+    """Process summaries until the process is terminated. With an upload_pool, a whole member is claimed at a time."""
+    worker_id = get_worker_id()
+    wakeup = get_wakeup(SUMMARIES_CHANNEL)
+    idle_sleep = None
+    while not process_terminated:
+        generation = wakeup.generation
+        raw_summaries_id = claim_next_raw_summaries(worker_id)
+        if raw_summaries_id is not None:
+            process_raw_summaries(raw_summaries_id, worker_id)
+            idle_sleep = None
+            continue
+
+        if upload_pool is not None:
+            claimed = claim_next_user_summaries(worker_id)
+        else:
+            claimed = claim_next_summaries(worker_id)
+        if claimed is not None:
+            if upload_pool is not None:
+                garmin_user_id, file_names = claimed
+                process_summaries_for_user(file_names, garmin_user_id, worker_id, upload_pool)
+            else:
+                garmin_user_id, file_name = claimed
+                process_summaries_for_user_and_file(file_name, garmin_user_id, worker_id)
+            idle_sleep = None
         else:
             # Nothing to do
-            time.sleep(0.5)
+            idle_sleep = next_idle_sleep(idle_sleep)
+            wakeup.wait(idle_sleep, generation)
 
 
 def update_retrieved_data_log(oh_user, summaries, file_name):
     if len(summaries) == 0:
         return  # Nothing to do
     data_type = "-".join(file_name.split("-")[:-2])
-    min_timestamp = min(map(lambda summary: extract_timestamp(summary).timestamp(), summaries))
-    max_timestamp = max(map(lambda summary: extract_timestamp(summary).timestamp(), summaries))
-    min_date = utc.localize(datetime.fromtimestamp(min_timestamp))
-    max_date = utc.localize(datetime.fromtimestamp(max_timestamp))
-    with handle_summaries_lock:
-        try:
-            retrieved_data = RetrievedData.objects.get(member=oh_user, data_type=data_type)
-            retrieved_data.min_date = min_date if min_date < retrieved_data.min_date else retrieved_data.min_date
-            retrieved_data.max_date = max_date if max_date > retrieved_data.max_date else retrieved_data.max_date
-        except ObjectDoesNotExist:
-            retrieved_data = RetrievedData(member=oh_user, data_type=data_type, min_date=min_date, max_date=max_date)
-        retrieved_data.save()
-
-
-def process_summaries_for_user_and_file(file_name, garmin_user_id):
-    summaries_to_process_all = SummariesToProcess.objects.filter(garmin_user_id__exact=garmin_user_id, file_name__exact=file_name)
+    epochs = summary_epochs(summaries)
+    min_date = datetime.fromtimestamp(min(epochs), utc)
+    max_date = datetime.fromtimestamp(max(epochs), utc)
+    # Widen the range in the database, so concurrent workers (also in other processes) never overwrite each other
+    widened = {
+        'min_date': Least('min_date', Value(min_date, output_field=DateTimeField())),
+        'max_date': Greatest('max_date', Value(max_date, output_field=DateTimeField())),
+    }
+    if RetrievedData.objects.filter(member=oh_user, data_type=data_type).update(**widened) > 0:
+        return
+    try:
+        with transaction.atomic():
+            RetrievedData.objects.create(member=oh_user, data_type=data_type, min_date=min_date, max_date=max_date)
+    except IntegrityError:
+        # Another worker created it in the meantime
+        RetrievedData.objects.filter(member=oh_user, data_type=data_type).update(**widened)
+
+
+def process_summaries_for_user(file_names, garmin_user_id, worker_id, upload_pool):
+    """
+    Process the claimed groups of one member in the upload_pool. The member, its access token and the listing of its
+    files are resolved once for all groups, and at most SUMMARIES_USER_MAX_CONCURRENCY groups of the member are in the
+    pool at a time, so the other members claimed by this process still get their turn.
+    """
+    pending = deque(file_names)
+    try:
+        oh_user = get_oh_user_from_garmin_id(garmin_user_id)
+        # Refreshes an expired token before the groups run concurrently, Open Humans only accepts a refresh token once
+        get_member_files(oh_user, oh_user.get_access_token())
+    except Exception:
+        _LOGGER.exception(f"Failed to prepare the summaries of garmin_user_id={garmin_user_id}")
+        for file_name in pending:
+            release_summaries(file_name, garmin_user_id, worker_id, failed=True)
+        return
+
+    running = {}  # future -> file_name
+    while len(pending) > 0 or len(running) > 0:
+        while len(pending) > 0 and len(running) < settings.SUMMARIES_USER_MAX_CONCURRENCY and not process_terminated:
+            file_name = pending.popleft()
+            running[upload_pool.submit(process_summaries_for_user_and_file, file_name, garmin_user_id, worker_id, oh_user)] = file_name
+        if len(running) == 0:
+            break  # Terminated
+        done, _ = wait(running, return_when=FIRST_COMPLETED)
+        for future in done:
+            file_name = running.pop(future)
+            if future.exception() is not None:
+                # process_summaries_for_user_and_file only releases the group itself when saving it fails, not when loading it does
+                _LOGGER.error(f"Failed to process {file_name} of garmin_user_id={garmin_user_id}", exc_info=future.exception())
+                release_summaries(file_name, garmin_user_id, worker_id, failed=True)
+
+    for file_name in pending:  # Left for the next worker
+        release_summaries(file_name, garmin_user_id, worker_id)
+    metrics.increment('summaries_users_processed')
+
+
+def process_summaries_for_user_and_file(file_name, garmin_user_id, worker_id, oh_user=None):
+    summaries_to_process_all = SummariesToProcess.objects.filter(garmin_user_id=garmin_user_id, file_name=file_name, claimed_by=worker_id)
     summaries = []
     ids_to_delete = []
+    push_ids = set()
     for summaries_to_process in summaries_to_process_all:
         ids_to_delete.append(summaries_to_process.id)
-        summaries += json.loads(summaries_to_process.summaries_json)
+        push_ids.add(summaries_to_process.push_id or summaries_to_process.id)  # Rows without a push_id count as a push each
+        summaries += load_summaries(summaries_to_process)
 
     try:
-        oh_user = get_oh_user_from_garmin_id(garmin_user_id)
-        all_summaries = merge_with_existing_and_upload(oh_user, summaries, file_name)
+        if oh_user is None:
+            oh_user = get_oh_user_from_garmin_id(garmin_user_id)
+        all_summaries = save_summaries(oh_user, summaries, file_name)
         update_retrieved_data_log(oh_user, all_summaries, file_name)
-        SummariesToProcess.objects.filter(id__in=ids_to_delete).delete()
+        # If our lease expired in the meantime, the rows now belong to another worker. It will merge them again, which is harmless.
+        SummariesToProcess.objects.filter(id__in=ids_to_delete, claimed_by=worker_id).delete()
+        metrics.increment('summaries_groups_processed')
+        metrics.increment('summaries_uploads_saved', len(push_ids) - 1)  # Without coalescing, every push would have been an upload
         _LOGGER.info(f"Saved {len(all_summaries)} summaries for garmin_user_id={garmin_user_id}, file_name={file_name}")
+        return True
 
-    except:
+    except Exception:
         e = sys.exc_info()[0]
         _LOGGER.error(f"Failed to handle summaries JSON {file_name} {e}")
         traceback.print_exc()
 
         # Reschedule handling
-        save_summaries_for_delayed_processing(file_name, garmin_user_id, summaries)
+        release_summaries(file_name, garmin_user_id, worker_id, failed=True)
+        return False
+
+
+def receive_summaries(stream, summaries_name, data_type, fields_to_remove=None):
+    """Handle the body of a Garmin push notification, either right away or by saving it raw for the worker."""
+    if settings.WEBHOOK_INGEST_MODE == 'raw':
+        save_raw_summaries(stream, summaries_name, data_type, fields_to_remove)
+    else:
+        handle_summaries_delayed(stream, summaries_name, data_type, fields_to_remove)
+
+
+def save_raw_summaries(stream, summaries_name, data_type, fields_to_remove=None):
+    raw_summaries = RawSummariesToProcess.objects.create(
+        body=compress_stream(stream),
+        summaries_name=summaries_name,
+        data_type=data_type,
+        fields_to_remove=json.dumps(fields_to_remove) if fields_to_remove is not None else None,
+    )
+    if use_celery():
+        from .tasks import process_raw_summaries as process_raw_summaries_task
+        process_raw_summaries_task.delay(raw_summaries.id)
+    else:
+        notify(SUMMARIES_CHANNEL)
 
 
-def handle_summaries_delayed(body, summaries_name, data_type, fields_to_remove=None):
-    body = body.decode('utf-8')
-    summaries = extract_summaries(body, summaries_name)
-    if fields_to_remove is not None:
-        remove_fields(summaries, fields_to_remove)
-    grouped_summaries = group_summaries_per_user_and_per_month(summaries)
-    for garmin_user_id, monthly_summaries in grouped_summaries.items():
-        for year_month, summaries in monthly_summaries.items():
-            file_name = f"{data_type}-{year_month}"
-            remove_unwanted_fields(summaries)
-            save_summaries_for_delayed_processing(file_name, garmin_user_id, summaries)
+def claim_next_raw_summaries(worker_id):
+    return claim_raw(RawSummariesToProcess.objects.filter(status=RawSummariesToProcess.PENDING).order_by('id'), worker_id)
 
 
-def save_summaries_for_delayed_processing(file_name, garmin_user_id, summaries):
+def claim_raw_summaries(raw_summaries_id, worker_id):
+    return claim_raw(RawSummariesToProcess.objects.filter(id=raw_summaries_id, status=RawSummariesToProcess.PENDING), worker_id) is not None
+
+
+def claim_raw(candidates, worker_id):
+    if connection.features.has_select_for_update_skip_locked:
+        candidates = candidates.select_for_update(skip_locked=True)
+
+    with transaction.atomic():
+        head = candidates.only('id').first()
+        if head is None:
+            return None
+        claim = {'status': RawSummariesToProcess.CLAIMED, 'claimed_by': worker_id, 'lease_expires_at': lease_expiry()}
+        if RawSummariesToProcess.objects.filter(id=head.id, status=RawSummariesToProcess.PENDING).update(**claim) == 0:
+            return None  # Another worker was faster
+    return head.id
+
+
+def process_raw_summaries(raw_summaries_id, worker_id):
+    raw_summaries = RawSummariesToProcess.objects.get(id=raw_summaries_id)
+    fields_to_remove = json.loads(raw_summaries.fields_to_remove) if raw_summaries.fields_to_remove is not None else None
+    try:
+        # Either all summaries of the push notification are saved for processing, or none
+        with transaction.atomic():
+            handle_summaries_delayed(DecompressingStream(bytes(raw_summaries.body)), raw_summaries.summaries_name, raw_summaries.data_type, fields_to_remove)
+            RawSummariesToProcess.objects.filter(id=raw_summaries_id, claimed_by=worker_id).delete()
+    except Exception:
+        e = sys.exc_info()[0]
+        _LOGGER.error(f"Failed to handle raw {raw_summaries.data_type} summaries {raw_summaries_id} {e}")
+        traceback.print_exc()
+
+        # Parsing it again won't help, keep it for inspection
+        RawSummariesToProcess.objects.filter(id=raw_summaries_id, claimed_by=worker_id).update(status=RawSummariesToProcess.FAILED)
+
+
+def handle_summaries_delayed(stream, summaries_name, data_type, fields_to_remove=None):
+    """
+    Save the summaries of a Garmin push notification for processing by the worker.
+    The body is parsed from the stream while it's read and the summaries are saved in chunks per user and month,
+    so memory usage doesn't depend on the size of the push notification.
+    """
+    pending_chunks = defaultdict(list)
+    saved_file_names = set()
+    push_id = uuid.uuid4().hex
+    groups_to_schedule = []
+
+    def save_chunk(garmin_user_id, file_name):
+        chunk = pending_chunks.pop((garmin_user_id, file_name))
+        # With Celery, a group that already had pending summaries before this push also has a queued task that will pick these up
+        if use_celery() and (garmin_user_id, file_name) not in saved_file_names and not has_pending_summaries(file_name, garmin_user_id):
+            groups_to_schedule.append((garmin_user_id, file_name))
+        save_summaries_for_delayed_processing(file_name, garmin_user_id, chunk, push_id)
+        saved_file_names.add((garmin_user_id, file_name))
+
+    for summaries in iter_batches(iter_summaries(stream, summaries_name), SUMMARIES_CHUNK_SIZE):
+        if fields_to_remove is not None:
+            remove_fields(summaries, fields_to_remove)
+        grouped_summaries = group_summaries_per_user_and_per_month(summaries)
+        for garmin_user_id, monthly_summaries in grouped_summaries.items():
+            for year_month, summaries_for_month in monthly_summaries.items():
+                file_name = f"{data_type}-{year_month}"
+                remove_unwanted_fields(summaries_for_month)
+                pending_chunks[(garmin_user_id, file_name)] += summaries_for_month
+                if len(pending_chunks[(garmin_user_id, file_name)]) >= SUMMARIES_CHUNK_SIZE:
+                    save_chunk(garmin_user_id, file_name)
+
+        # Summaries spread over many users and months would otherwise all stay in memory until the end
+        if sum(map(len, pending_chunks.values())) >= SUMMARIES_MAX_BUFFERED:
+            for garmin_user_id, file_name in list(pending_chunks.keys()):
+                save_chunk(garmin_user_id, file_name)
+
+    for garmin_user_id, file_name in list(pending_chunks.keys()):
+        save_chunk(garmin_user_id, file_name)
+
+    # Only once all chunks are saved, a task that runs right away (e.g. eager tasks) would miss the later chunks
+    for garmin_user_id, file_name in groups_to_schedule:
+        schedule_summaries(file_name, garmin_user_id, countdown=settings.SUMMARIES_QUIET_SECONDS)
+
+    if not use_celery() and len(saved_file_names) > 0:
+        # When called in a transaction (process_raw_summaries), the workers only see the summaries after the commit
+        transaction.on_commit(lambda: notify(SUMMARIES_CHANNEL))
+
+
+def use_celery():
+    return settings.WORKER_MODE == 'celery'
+
+
+def schedule_summaries(file_name, garmin_user_id, countdown=None):
+    """Queue the task processing the summaries, once the current transaction (if any) commits and they are visible to it."""
+    from .tasks import process_summaries
+    transaction.on_commit(lambda: process_summaries.apply_async((file_name, garmin_user_id), countdown=countdown))
+
+
+def schedule_backfill(garmin_member):
+    if use_celery():
+        from .tasks import backfill_member
+        backfill_member.delay(garmin_member.id)
+    else:
+        notify(BACKFILL_CHANNEL)
+
+
+def save_summaries_for_delayed_processing(file_name, garmin_user_id, summaries, push_id=None):
     _LOGGER.info(f"Saving {len(summaries)} summaries {file_name} for user {garmin_user_id} for further processing")
+    summaries_json = json.dumps(summaries)
     summaries_to_process = SummariesToProcess()
-    summaries_to_process.summaries_json = json.dumps(summaries)
+    summaries_to_process.summaries_data = compress_json_string(summaries_json)
     summaries_to_process.garmin_user_id = garmin_user_id
     summaries_to_process.file_name = file_name
+    summaries_to_process.summaries_count = len(summaries)
+    summaries_to_process.size_bytes = len(summaries_json)
+    summaries_to_process.push_id = push_id
     summaries_to_process.save()
+
+
+def load_summaries(summaries_to_process):
+    if summaries_to_process.summaries_data is not None:
+        return decompress_json(summaries_to_process.summaries_data)
+    return json.loads(summaries_to_process.summaries_json)
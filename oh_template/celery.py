@@ -7,8 +7,6 @@ os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'oh_template.settings')
 
 app = Celery('oh-garmin-health')
 
-app.conf.update({'BROKER_URL': os.getenv('REDIS_URL', 'redis://')})
-
 # Using a string here means the worker doesn't have to serialize
 # the configuration object to child processes.
 # - namespace='CELERY' means all celery-related configuration keys
@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/2.1/ref/settings/
 """
 
 import os
+import tempfile
 
 import dj_database_url
 import django_heroku
@@ -152,6 +153,72 @@ GARMIN_SECRET = os.environ['GARMIN_SECRET']
 
 NUM_OF_SUMMARY_UPLOAD_THREADS = int(os.environ['NUM_OF_SUMMARY_UPLOAD_THREADS'])
 
+# Local disk cache of the monthly summary files we uploaded to Open Humans. Set the size to 0 to disable it.
+SUMMARIES_CACHE_DIR = os.environ.get('SUMMARIES_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'garmin-summaries-cache'))
+SUMMARIES_CACHE_MAX_BYTES = int(os.environ.get('SUMMARIES_CACHE_MAX_BYTES', 1024 * 1024 * 1024))
+
+# How long the worker keeps the listing of the files of a member on Open Humans. Changes by other worker processes are
+# noticed right away (see MemberFilesCache), this only limits how long changes made outside of the worker go unnoticed. 0 disables it.
+OH_FILES_CACHE_SECONDS = int(os.environ.get('OH_FILES_CACHE_SECONDS', 60))
+
+# 'monthly' rewrites the monthly file on Open Humans for every batch of summaries. 'delta' uploads every batch as a small
+# delta file instead, and merges the deltas into the monthly file once there are SUMMARIES_DELTA_MAX_FILES deltas or
+# they hold more than SUMMARIES_DELTA_MAX_SUMMARIES summaries
+SUMMARIES_FILE_LAYOUT = os.environ.get('SUMMARIES_FILE_LAYOUT', 'monthly')
+SUMMARIES_DELTA_MAX_FILES = int(os.environ.get('SUMMARIES_DELTA_MAX_FILES', 20))
+SUMMARIES_DELTA_MAX_SUMMARIES = int(os.environ.get('SUMMARIES_DELTA_MAX_SUMMARIES', 10000))
+
+# 'json' uploads the summary files as plain JSON, 'gzip' as gzip compressed JSON (.json.gz, tagged garmin-health-api-gzip).
+# Both formats are read, `manage.py reencode_files` converts existing files.
+SUMMARIES_FILE_FORMAT = os.environ.get('SUMMARIES_FILE_FORMAT', 'json')
+
+# 'parse' parses push notifications from Garmin before answering, 'raw' only saves the compressed body and lets the worker parse it
+WEBHOOK_INGEST_MODE = os.environ.get('WEBHOOK_INGEST_MODE', 'parse')
+
+# Summaries for a data file are only processed once no new summaries arrived for SUMMARIES_QUIET_SECONDS, or once
+# SUMMARIES_MAX_COUNT summaries / SUMMARIES_MAX_BYTES are pending, but never later than SUMMARIES_MAX_STALENESS_SECONDS
+SUMMARIES_QUIET_SECONDS = int(os.environ.get('SUMMARIES_QUIET_SECONDS', 30))
+SUMMARIES_MAX_COUNT = int(os.environ.get('SUMMARIES_MAX_COUNT', 10000))
+SUMMARIES_MAX_BYTES = int(os.environ.get('SUMMARIES_MAX_BYTES', 10 * 1024 * 1024))
+SUMMARIES_MAX_STALENESS_SECONDS = int(os.environ.get('SUMMARIES_MAX_STALENESS_SECONDS', 300))
+
+# 'file' claims the pending summaries of one data file at a time. 'user' claims all ready data files of a member at once and
+# uploads them in a pool of SUMMARIES_UPLOAD_POOL_THREADS threads, at most SUMMARIES_USER_MAX_CONCURRENCY per member
+SUMMARIES_CLAIM_MODE = os.environ.get('SUMMARIES_CLAIM_MODE', 'file')
+SUMMARIES_UPLOAD_POOL_THREADS = int(os.environ.get('SUMMARIES_UPLOAD_POOL_THREADS', 8))
+SUMMARIES_USER_MAX_CONCURRENCY = int(os.environ.get('SUMMARIES_USER_MAX_CONCURRENCY', 4))
+
+# Connection pool shared by the calls to Garmin and Open Humans, see main/http_pool.py
+HTTP_POOL_HOSTS = int(os.environ.get('HTTP_POOL_HOSTS', 10))
+HTTP_POOL_CONNECTIONS_PER_HOST = int(os.environ.get('HTTP_POOL_CONNECTIONS_PER_HOST', 10))
+HTTP_CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', 10))
+HTTP_READ_TIMEOUT = float(os.environ.get('HTTP_READ_TIMEOUT', 60))
+
+# Members that are backfilled at the same time, and the limit for the backfill calls of all members together
+BACKFILL_MAX_CONCURRENT_MEMBERS = int(os.environ.get('BACKFILL_MAX_CONCURRENT_MEMBERS', 10))
+BACKFILL_MAX_CALLS_PER_SECOND = float(os.environ.get('BACKFILL_MAX_CALLS_PER_SECOND', 1))
+BACKFILL_NUM_THREADS = int(os.environ.get('BACKFILL_NUM_THREADS', 4))
+
+# Process summaries and backfills in the threads of `manage.py run_worker` ('threads') or as Celery tasks ('celery')
+WORKER_MODE = os.environ.get('WORKER_MODE', 'threads')
+
+# Celery configuration, see oh_template/celery.py
+CELERY_BROKER_URL = os.getenv('REDIS_URL', 'redis://')
+CELERY_TASK_ALWAYS_EAGER = os.environ.get('CELERY_TASK_ALWAYS_EAGER', 'false').lower() == 'true'  # Run tasks synchronously, without a broker
+CELERY_TASK_ROUTES = {
+    'main.tasks.process_summaries': {'queue': 'summaries'},
+    'main.tasks.process_raw_summaries': {'queue': 'summaries'},
+    'main.tasks.schedule_pending_summaries': {'queue': 'summaries'},
+    'main.tasks.backfill_member': {'queue': 'backfill'},
+}
+CELERY_BACKFILL_RATE_LIMIT = os.environ.get('CELERY_BACKFILL_RATE_LIMIT', '1/m')  # Backfills started per Celery worker
+CELERY_BEAT_SCHEDULE = {
+    'schedule-pending-summaries': {
+        'task': 'main.tasks.schedule_pending_summaries',
+        'schedule': 300,
+    },
+}
+
 # Redirect after login (via Open Humans member account) or logout.
 LOGIN_REDIRECT_URL = '/'
 LOGOUT_REDIRECT_URL = '/'